@@ -1,33 +1,130 @@
+import argparse
 import asyncio
 import aiohttp
+import bisect
+import cProfile
+import contextlib
+import csv
+import errno
+import functools
+import heapq
 import ipaddress
+import mmap
 import random
+import signal
+import socket
 import sqlite3
+import struct
 import time
 import json
+import logging
+import math
+import logging.handlers
+import multiprocessing
+import pstats
 import os
 import sys
+import tempfile
+import threading
+import queue
+from array import array
+from itertools import islice
+from collections import OrderedDict, deque
 from datetime import datetime
-from typing import List, Tuple, Optional, Dict, Set
+from urllib.parse import urlsplit
+try:
+    import resource
+except ImportError:
+    resource = None
+from typing import List, Tuple, Optional, Dict, Set, Iterable, Iterator, Any, Awaitable, Callable
 
 # ========== CONFIGURATION ==========
 DEFAULT_PORTS = [80, 8080, 3128, 8000, 8888, 1080]
 DEFAULT_TIMEOUT = 5
 DEFAULT_THREADS = 200
+DEFAULT_CONNECT_TIMEOUT = 1.5
+DEFAULT_PROBE_ENGINE = "aiohttp"
+PROBE_ENGINES = ("aiohttp", "raw")
+TUNNEL_PROTOCOLS = ("CONNECT", "SOCKS5", "SOCKS4")
+PROBE_ORDER = ("HTTP", "SOCKS5", "SOCKS4")
+SOCKS_PROBE_ORDER = ("SOCKS5", "SOCKS4", "HTTP")
+SOCKS_PORTS = {1080, 1081, 4145, 9050}
+FINGERPRINT_TIMEOUT_FACTOR = 2
+CONNECT_CONCURRENCY_FACTOR = 4
+DEAD_HOST_CONNECT_TIMEOUT = 0.5
+DEAD_HOST_CACHE_SIZE = 100000
+HOST_FAILURE_CACHE_SIZE = 100000
+AIMD_INTERVAL = 1.0
+AIMD_MIN_SAMPLES = 50
+AIMD_INCREASE = 10
+AIMD_DECREASE = 0.7
+AIMD_TIMEOUT_MARGIN = 0.05
+AIMD_MAX_LOOP_LAG = 0.1
+FD_HEADROOM = 64
+BANDIT_PRIOR_PROBES = 1000
+BANDIT_ARM_BATCH = 64
+PRIORITISED_SCAN_TYPE = "Prioritised Range Scan"
+DEFAULT_PROCESSES = 1
+MAX_PROCESSES = os.cpu_count() or 1
+DISTRIBUTED_SCAN_TYPE = "Distributed Scan"
+DEFAULT_UNIT_SIZE = 50000
+LEASE_SECONDS = 120
+DEFAULT_REVALIDATE_RATE = 5
+REVALIDATE_MIN_INTERVAL = 600
+REVALIDATE_MAX_INTERVAL = 24 * 3600
+REVALIDATE_GROWTH = 2
+REVALIDATE_RETRY = 60
+REVALIDATE_MAX_FAILURES = 5
+REVALIDATE_RELOAD = 60
+REVALIDATE_JITTER = 0.1
+NEGATIVE_CACHE_TTL = {'refused': 24 * 3600, 'timeout': 3600, 'bad_response': 6 * 3600}
+NEGATIVE_CACHE_RECENT_SIZE = 65536
+LOCAL_ERRNOS = {errno.EMFILE, errno.ENFILE, errno.EADDRNOTAVAIL, errno.ENOBUFS, errno.EADDRINUSE}
 TEST_URL = "http://www.google.com/generate_204"
+JUDGE_PROXY_HEADERS = ('via', 'x-forwarded-for', 'forwarded', 'x-real-ip', 'client-ip',
+                       'x-proxy-id', 'proxy-connection')
 MAX_RETRIES = 2
 MAX_RANDOM_IPS = 5000
 MIN_WORKING_RANGE_IPS = 10
+PROGRESS_INTERVAL = 0.5
+CHECKPOINT_INTERVAL = 5
 DEBUG_LOG_FILE = "debug.log"
+DEBUG_LOG_BUFFER = 1000
+DEBUG_LOG_MAX_BYTES = 5 * 1024 * 1024
+DEBUG_LOG_BACKUPS = 3
+RANGE_INDEX_SUFFIX = ".idx"
+DB_BATCH_SIZE = 500
+DB_FLUSH_INTERVAL = 1.0
+DB_WRITE_RETRIES = 5
+DB_RETRY_DELAY = 0.1
+BLOOM_ERROR_RATE = 0.001
+SAMPLER_DRAW_ATTEMPTS = 4
+GEOIP_CACHE_SIZE = 65536
+LATENCY_SAMPLES = 3
+LATENCY_HISTORY = 30
+LATENCY_READ_LIMIT = 65536
+METRICS_WINDOW = 11
+METRICS_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+BENCH_FARM_MIX = (('working', 0.2), ('slow', 0.1), ('tarpit', 0.1), ('reset', 0.1),
+                  ('garbage', 0.1), ('closed', 0.4))
+BENCH_TIMEOUT = 2
+BENCH_SLOW_DELAY = 0.5
+PROFILE_MODES = ("off", "timers", "cprofile")
+PROFILE_ENV = "PROXY_SCANNER_PROFILE"
+PROXY_PAGE_SIZE = 20
+EXPORT_BATCH = 1000
+EXPORT_FORMATS = ("jsonl", "csv", "txt", "pac")
 
 # ========== FILE PATHS ==========
 IP_RANGES_FILE = "ipranges.txt"
 OPEN_PROXIES_FILE = "open_proxies.txt"
 WORKING_PROXIES_FILE = "working_proxies.txt"
 WORKING_RANGES_FILE = "working_ranges.txt"
+GEOIP_FILE = "geoip.csv"
 CONFIG_FILE = "proxy_scanner.cfg"
 DATABASE_FILE = "proxies.db"
 RESULTS_FILE = "results.txt"
+PROFILE_FILE = "profile_{run_id}"
 
 # ========== COLORS ==========
 class Colors:
@@ -56,29 +153,1429 @@ IRANIAN_TEST_SITES = [
     "http://www.yjc.ir/"
 ]
 
-class ProxyScanner:
+# ========== LOGGING ==========
+class RingBufferHandler(logging.Handler):
+    """Keeps the last `capacity` formatted messages for the debug log view."""
+    def __init__(self, capacity: int):
+        super().__init__()
+        self.records = deque(maxlen=capacity)
+
+    def emit(self, record: logging.LogRecord) -> None:
+        self.records.append(self.format(record))
+
+
+class ConsoleHandler(logging.StreamHandler):
+    def format(self, record: logging.LogRecord) -> str:
+        return f"{Colors.MAGENTA}{super().format(record)}{Colors.RESET}"
+
+
+def setup_logging(buffer: RingBufferHandler,
+                  log_file: Optional[str] = DEBUG_LOG_FILE) -> Tuple[logging.Logger, logging.handlers.QueueListener]:
+    """Route scanner logs through a queue to a rotating file, the ring buffer and the console."""
+    formatter = logging.Formatter("[%(levelname)s][%(asctime)s.%(msecs)03d] %(message)s",
+                                  "%Y-%m-%d %H:%M:%S")
+    handlers = [buffer, ConsoleHandler(sys.stdout)]
+    if log_file:
+        handlers.append(logging.handlers.RotatingFileHandler(
+            log_file, maxBytes=DEBUG_LOG_MAX_BYTES, backupCount=DEBUG_LOG_BACKUPS, encoding='utf-8'))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    
+    log_queue = queue.SimpleQueue()
+    logger = logging.getLogger("proxy_scanner")
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+    logger.handlers[:] = [logging.handlers.QueueHandler(log_queue)]
+    listener = logging.handlers.QueueListener(log_queue, *handlers)
+    listener.start()
+    return logger, listener
+
+# ========== DATABASE WRITER ==========
+def configure_connection(conn: sqlite3.Connection) -> None:
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    conn.execute('PRAGMA cache_size=-16000')
+
+
+class DatabaseWriter(threading.Thread):
+    """Background thread committing queued statements every DB_BATCH_SIZE rows or DB_FLUSH_INTERVAL seconds."""
+    def __init__(self, path: str, batch_size: int = DB_BATCH_SIZE, interval: float = DB_FLUSH_INTERVAL,
+                 profiler: Optional['StageProfiler'] = None):
+        super().__init__(name="db-writer", daemon=True)
+        self.path = path
+        self.profiler = profiler
+        self.batch_size = batch_size
+        self.interval = interval
+        self.queue = queue.Queue()
+
+    def submit(self, sql: str, params: tuple) -> None:
+        self.queue.put((sql, params))
+
+    def flush(self) -> None:
+        """Block until everything submitted so far is committed."""
+        if not self.is_alive():
+            return
+        done = threading.Event()
+        self.queue.put(done)
+        done.wait()
+
+    def stop(self) -> None:
+        self.queue.put(None)
+        self.join()
+
+    def run(self) -> None:
+        conn = sqlite3.connect(self.path, timeout=30)
+        configure_connection(conn)
+        running = True
+        while running:
+            batch = []
+            item = self.queue.get()
+            deadline = time.monotonic() + self.interval
+            while isinstance(item, tuple):
+                batch.append(item)
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.batch_size or remaining <= 0:
+                    item = False
+                    break
+                try:
+                    item = self.queue.get(timeout=remaining)
+                except queue.Empty:
+                    item = False
+            if batch and self.profiler is not None:
+                with self.profiler.stage('db_commit'):
+                    self._write(conn, batch)
+            else:
+                self._write(conn, batch)
+            if item is None:
+                running = False
+            elif isinstance(item, threading.Event):
+                item.set()
+        conn.close()
+
+    def _write(self, conn: sqlite3.Connection, batch: List[Tuple[str, tuple]]) -> None:
+        """Commit `batch`, retrying a busy database with backoff.
+
+        Any other error replays the batch one row per transaction, so only
+        the rows that fail are dropped.
+        """
+        if not batch:
+            return
+        for attempt in range(DB_WRITE_RETRIES + 1):
+            try:
+                with conn:
+                    start = 0
+                    for i in range(1, len(batch) + 1):
+                        if i == len(batch) or batch[i][0] != batch[start][0]:
+                            conn.executemany(batch[start][0], [params for _, params in batch[start:i]])
+                            start = i
+                return
+            except sqlite3.OperationalError as e:
+                error = e
+                if not database_busy(e):
+                    break
+                if attempt < DB_WRITE_RETRIES:
+                    time.sleep(DB_RETRY_DELAY * 2 ** attempt)
+            except sqlite3.Error as e:
+                error = e
+                break
+        if database_busy(error):
+            print(f"{Colors.YELLOW}[!] Database busy, dropped {len(batch)} rows: {error}{Colors.RESET}")
+            return
+        dropped = 0
+        for sql, params in batch:
+            try:
+                with conn:
+                    conn.execute(sql, params)
+            except sqlite3.Error as e:
+                dropped += 1
+                error = e
+        if dropped:
+            print(f"{Colors.YELLOW}[!] Database error, dropped {dropped} of {len(batch)} rows: {error}{Colors.RESET}")
+
+def database_busy(error: sqlite3.Error) -> bool:
+    """Whether `error` is a lock conflict that may clear on retry."""
+    message = str(error)
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+# ========== RAW PROBE ENGINE ==========
+class TunnelRefused(ValueError):
+    """The endpoint answered in the tunnel protocol we tried, but refused the tunnel."""
+
+class RawProxyProbe:
+    """Minimal forward-proxy and tunnel client over asyncio streams."""
+    def __init__(self, urls: List[str]):
+        self.requests = {url: [self.render(url, ua) for ua in USER_AGENTS] for url in urls}
+
+    @staticmethod
+    def render(url: str, user_agent: str) -> bytes:
+        host = url.split('/')[2]
+        return (f"GET {url} HTTP/1.1\r\n"
+                f"Host: {host}\r\n"
+                f"User-Agent: {user_agent}\r\n"
+                "Accept: text/html,application/xhtml+xml\r\n"
+                "Accept-Encoding: gzip, deflate\r\n"
+                "Connection: close\r\n\r\n").encode('ascii')
+
+    async def fetch(self, ip: str, port: int, url: str, timeout: float) -> Tuple[int, Dict[str, str]]:
+        return await asyncio.wait_for(self._fetch(ip, port, url), timeout)
+
+    async def _fetch(self, ip: str, port: int, url: str) -> Tuple[int, Dict[str, str]]:
+        reader, writer = await asyncio.open_connection(ip, port)
+        try:
+            writer.write(random.choice(self.requests[url]))
+            head = await reader.readuntil(b"\r\n\r\n")
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            raise ValueError(f"Malformed proxy response: {e}")
+        finally:
+            writer.close()
+        return parse_response_head(head)
+
+    async def timed_fetch(self, ip: str, port: int, url: str, timeout: float,
+                          request: Optional[bytes] = None) -> Tuple[int, bytes, float, float, float]:
+        """Like fetch, but returns (status, body, connect, first byte, total), times in seconds.
+
+        `request` overrides the cached rendering, for one-off URLs such as a judge nonce.
+        """
+        return await asyncio.wait_for(self._timed_fetch(ip, port, url, request), timeout)
+
+    async def _timed_fetch(self, ip: str, port: int, url: str,
+                           request: Optional[bytes]) -> Tuple[int, bytes, float, float, float]:
+        if request is None:
+            if url not in self.requests:
+                self.requests[url] = [self.render(url, ua) for ua in USER_AGENTS]
+            request = random.choice(self.requests[url])
+        started = time.perf_counter()
+        reader, writer = await asyncio.open_connection(ip, port)
+        connected = time.perf_counter()
+        try:
+            writer.write(request)
+            first = await reader.read(1)
+            first_byte = time.perf_counter()
+            head = first + await reader.readuntil(b"\r\n\r\n")
+            status, headers = parse_response_head(head)
+            length = headers.get('content-length', '')
+            if length.isdigit():
+                body = await reader.readexactly(min(int(length), LATENCY_READ_LIMIT))
+            else:
+                body = await reader.read(LATENCY_READ_LIMIT)
+            finished = time.perf_counter()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            raise ValueError(f"Malformed proxy response: {e}")
+        finally:
+            writer.close()
+        return status, body, connected - started, first_byte - started, finished - started
+
+    async def open_tunnel(self, ip: str, port: int, protocol: str, host: str,
+                          target_port: int) -> Tuple[asyncio.StreamReader, asyncio.StreamWriter]:
+        """Connect to ip:port and negotiate a CONNECT, SOCKS5 or SOCKS4a tunnel to host:target_port.
+
+        Raises TunnelRefused if the endpoint speaks the protocol but refuses,
+        ValueError or EOF errors if it does not speak it at all.
+        """
+        reader, writer = await asyncio.open_connection(ip, port)
+        try:
+            if protocol == 'CONNECT':
+                writer.write(f"CONNECT {host}:{target_port} HTTP/1.1\r\n"
+                             f"Host: {host}:{target_port}\r\n\r\n".encode('ascii'))
+                status, _ = parse_response_head(await reader.readuntil(b"\r\n\r\n"))
+                if status != 200:
+                    raise TunnelRefused(f"CONNECT answered {status}")
+            elif protocol == 'SOCKS5':
+                writer.write(self.socks_request(protocol, host, target_port))
+                method = await reader.readexactly(2)
+                if method[0] != 5:
+                    raise ValueError(f"Not a SOCKS5 reply: {method!r}")
+                if method[1] != 0:
+                    raise TunnelRefused("SOCKS5 requires authentication")
+                await self.read_socks5_reply(reader)
+            elif protocol == 'SOCKS4':
+                writer.write(self.socks_request(protocol, host, target_port))
+                reply = await reader.readexactly(8)
+                if reply[0] != 0 or not 0x5a <= reply[1] <= 0x5d:
+                    raise ValueError(f"Not a SOCKS4 reply: {reply!r}")
+                if reply[1] != 0x5a:
+                    raise TunnelRefused(f"SOCKS4 reply code {reply[1]:#x}")
+            else:
+                raise ValueError(f"Unknown tunnel protocol {protocol}")
+        except BaseException:
+            writer.close()
+            raise
+        return reader, writer
+
+    @staticmethod
+    def socks_request(protocol: str, host: str, target_port: int) -> bytes:
+        """Opening bytes of a SOCKS5 or SOCKS4a CONNECT to host:target_port."""
+        if protocol == 'SOCKS5':
+            # Greeting and request pipelined: a no-auth server answers both in one round trip
+            return (b"\x05\x01\x00\x05\x01\x00\x03" + bytes([len(host)]) + host.encode('ascii')
+                    + target_port.to_bytes(2, 'big'))
+        return (b"\x04\x01" + target_port.to_bytes(2, 'big') + b"\x00\x00\x00\x01\x00"
+                + host.encode('ascii') + b"\x00")
+
+    @staticmethod
+    async def read_socks5_reply(reader: asyncio.StreamReader) -> None:
+        reply = await reader.readexactly(4)
+        if reply[1] != 0:
+            raise TunnelRefused(f"SOCKS5 reply code {reply[1]}")
+        address_length = {1: 4, 4: 16}.get(reply[3]) or (await reader.readexactly(1))[0]
+        await reader.readexactly(address_length + 2)
+
+    async def identify(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, probe: str,
+                       url: str) -> Tuple[str, Optional[Tuple[int, Dict[str, str]]]]:
+        """Send the `probe` opener ('HTTP', 'SOCKS5' or 'SOCKS4') for url and classify the first reply.
+
+        Returns (protocol of the reply, (status, headers) for an HTTP reply).
+        Raises TunnelRefused on a SOCKS refusal, ValueError or EOF errors on a
+        reply in no known protocol.
+        """
+        if probe == 'HTTP':
+            if url not in self.requests:
+                self.requests[url] = [self.render(url, ua) for ua in USER_AGENTS]
+            writer.write(random.choice(self.requests[url]))
+        else:
+            parts = urlsplit(url)
+            writer.write(self.socks_request(probe, parts.hostname, parts.port or 80))
+        lead = await reader.readexactly(2)
+        if lead[0] == 5:
+            if lead[1] != 0:
+                raise TunnelRefused(f"SOCKS5 method {lead[1]:#x}")
+            if probe == 'SOCKS5':
+                await self.read_socks5_reply(reader)
+            return 'SOCKS5', None
+        if lead[0] == 0 and 0x5a <= lead[1] <= 0x5d:
+            if lead[1] != 0x5a:
+                raise TunnelRefused(f"SOCKS4 reply code {lead[1]:#x}")
+            return 'SOCKS4', None
+        if lead == b"HT":
+            return 'HTTP', parse_response_head(lead + await reader.readuntil(b"\r\n\r\n"))
+        raise ValueError(f"Unrecognised reply: {lead!r}")
+
+    async def fingerprint(self, ip: str, port: int, timeout: float,
+                          protocols: Iterable[str] = TUNNEL_PROTOCOLS) -> Optional[str]:
+        """Tunnel protocol spoken by ip:port (one of `protocols`) or None.
+
+        Candidates go in order, one connection each. SOCKS servers drop an
+        HTTP request at once and HTTP proxies answer it, so the search stops
+        at the first reply in a known protocol, and at the first silent endpoint.
+        Local socket errors (LOCAL_ERRNOS) are raised.
+        """
+        host = urlsplit(TEST_URL).hostname
+        for protocol in protocols:
+            try:
+                _, writer = await asyncio.wait_for(
+                    self.open_tunnel(ip, port, protocol, host, 443 if protocol == 'CONNECT' else 80), timeout)
+            except TunnelRefused:
+                return None
+            except asyncio.TimeoutError:
+                return None
+            except OSError as e:
+                if e.errno in LOCAL_ERRNOS:
+                    raise
+                continue
+            except (ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+                continue
+            writer.close()
+            return protocol
+        return None
+
+    async def fetch_through_tunnel(self, ip: str, port: int, protocol: str, url: str,
+                                   timeout: float) -> Tuple[int, Dict[str, str], bytes]:
+        """GET url through a tunnel proxy; returns (status, headers, body)."""
+        return await asyncio.wait_for(self._fetch_through_tunnel(ip, port, protocol, url), timeout)
+
+    async def _fetch_through_tunnel(self, ip: str, port: int, protocol: str,
+                                    url: str) -> Tuple[int, Dict[str, str], bytes]:
+        parts = urlsplit(url)
+        reader, writer = await self.open_tunnel(ip, port, protocol, parts.hostname, parts.port or 80)
+        try:
+            path = parts.path or "/"
+            if parts.query:
+                path += f"?{parts.query}"
+            writer.write((f"GET {path} HTTP/1.1\r\n"
+                          f"Host: {parts.netloc}\r\n"
+                          f"User-Agent: {random.choice(USER_AGENTS)}\r\n"
+                          "Connection: close\r\n\r\n").encode('ascii'))
+            head = await reader.readuntil(b"\r\n\r\n")
+            body = await reader.read(LATENCY_READ_LIMIT)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+            raise ValueError(f"Malformed response through tunnel: {e}")
+        finally:
+            writer.close()
+        status, headers = parse_response_head(head)
+        return status, headers, body
+
+def parse_response_head(head: bytes) -> Tuple[int, Dict[str, str]]:
+    lines = head.decode('latin-1').split("\r\n")
+    parts = lines[0].split(' ', 2)
+    if len(parts) < 2 or not parts[0].startswith("HTTP/") or not parts[1].isdigit():
+        raise ValueError(f"Bad status line: {lines[0][:40]!r}")
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+    return int(parts[1]), headers
+
+# ========== LATENCY ==========
+def percentile(values: List[float], q: float) -> float:
+    """Nearest-rank percentile of a non-empty list."""
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(q / 100 * len(ordered)) - 1)]
+
+def latency_summary(totals: List[float]) -> Tuple[float, float, float]:
+    """(p50, p95, jitter) of total times; jitter is the mean change between consecutive samples."""
+    jitter = (sum(abs(b - a) for a, b in zip(totals, totals[1:])) / (len(totals) - 1)
+              if len(totals) > 1 else 0.0)
+    return percentile(totals, 50), percentile(totals, 95), jitter
+
+class LatencyHistory:
+    """Last LATENCY_HISTORY total times (ms) per proxy, oldest first, keyed by (integer ip, port)."""
     def __init__(self):
+        self.totals = {}
+
+    @classmethod
+    def load(cls, conn: sqlite3.Connection) -> 'LatencyHistory':
+        history = cls()
+        for ip, port, total in conn.execute('SELECT ip, port, total_us FROM latency_history ORDER BY ip, port, at'):
+            history.add(ip, port, [total / 1000])
+        return history
+
+    def add(self, ip: int, port: int, totals: List[float]) -> List[float]:
+        """Append `totals` for ip:port and return its whole history."""
+        history = self.totals.get((ip, port))
+        if history is None:
+            history = self.totals[(ip, port)] = deque(maxlen=LATENCY_HISTORY)
+        history.extend(totals)
+        return list(history)
+
+# ========== METRICS ==========
+class LoopLagWatcher:
+    """Reference-counted event-loop lag sampler shared by the metrics endpoint and the AIMD limiter."""
+    def __init__(self, interval: float = 0.25):
+        self.interval = interval
+        self.lag = 0.0
+        self.peak = 0.0
+        self._users = 0
+        self._task = None
+
+    def start(self) -> None:
+        self._users += 1
+        if self._task is None:
+            self._task = asyncio.ensure_future(self._watch())
+
+    def stop(self) -> None:
+        self._users = max(0, self._users - 1)
+        if not self._users and self._task:
+            self._task.cancel()
+            self._task = None
+
+    def take_peak(self) -> float:
+        peak, self.peak = self.peak, 0.0
+        return peak
+
+    async def _watch(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = loop.time() - started - self.interval
+            self.peak = max(self.peak, self.lag)
+
+class ScanMetrics:
+    """Live probe counters, rendered in Prometheus text format for the metrics endpoint."""
+    def __init__(self, lag: LoopLagWatcher):
+        self.lag = lag
+        self.in_flight = 0
+        self.probes = 0
+        self.window = [0] * METRICS_WINDOW
+        self.second = int(time.monotonic())
+        self.outcomes = {}
+        self.hits = {}
+        self.histograms = {}
+
+    def _advance(self) -> None:
+        now = int(time.monotonic())
+        for second in range(self.second + 1, min(now, self.second + METRICS_WINDOW) + 1):
+            self.window[second % METRICS_WINDOW] = 0
+        self.second = max(self.second, now)
+
+    def probe_started(self) -> None:
+        self.in_flight += 1
+
+    def probe_finished(self) -> None:
+        self.in_flight -= 1
+        self.probes += 1
+        self._advance()
+        self.window[self.second % METRICS_WINDOW] += 1
+
+    def outcome(self, stage: str, outcome: str) -> None:
+        key = (stage, outcome)
+        self.outcomes[key] = self.outcomes.get(key, 0) + 1
+
+    def hit(self, port: int) -> None:
+        self.hits[port] = self.hits.get(port, 0) + 1
+
+    def observe(self, stage: str, seconds: float) -> None:
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = [0] * (len(METRICS_BUCKETS) + 1) + [0.0]
+        histogram[bisect.bisect_left(METRICS_BUCKETS, seconds)] += 1
+        histogram[-1] += seconds
+
+    def probes_per_second(self) -> float:
+        self._advance()
+        return (sum(self.window) - self.window[self.second % METRICS_WINDOW]) / (METRICS_WINDOW - 1)
+
+    def render(self) -> str:
+        lines = [
+            "# TYPE proxy_scanner_probes_in_flight gauge",
+            f"proxy_scanner_probes_in_flight {self.in_flight}",
+            "# TYPE proxy_scanner_probes_total counter",
+            f"proxy_scanner_probes_total {self.probes}",
+            "# TYPE proxy_scanner_probes_per_second gauge",
+            f"proxy_scanner_probes_per_second {self.probes_per_second():.2f}",
+            "# TYPE proxy_scanner_event_loop_lag_seconds gauge",
+            f"proxy_scanner_event_loop_lag_seconds {self.lag.lag:.6f}",
+            "# TYPE proxy_scanner_probe_outcomes_total counter",
+        ]
+        lines += [f'proxy_scanner_probe_outcomes_total{{stage="{stage}",outcome="{outcome}"}} {count}'
+                  for (stage, outcome), count in sorted(self.outcomes.items())]
+        lines.append("# TYPE proxy_scanner_hits_total counter")
+        lines += [f'proxy_scanner_hits_total{{port="{port}"}} {count}' for port, count in sorted(self.hits.items())]
+        lines.append("# TYPE proxy_scanner_stage_seconds histogram")
+        for stage, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, count in zip(METRICS_BUCKETS + (float('inf'),), histogram):
+                cumulative += count
+                le = "+Inf" if bound == float('inf') else bound
+                lines.append(f'proxy_scanner_stage_seconds_bucket{{stage="{stage}",le="{le}"}} {cumulative}')
+            lines.append(f'proxy_scanner_stage_seconds_sum{{stage="{stage}"}} {histogram[-1]:.6f}')
+            lines.append(f'proxy_scanner_stage_seconds_count{{stage="{stage}"}} {cumulative}')
+        return "\n".join(lines) + "\n"
+
+
+def http_error_kind(error: Exception) -> str:
+    """Bucket a proxied-request failure for the error taxonomy."""
+    if isinstance(error, asyncio.TimeoutError):
+        return 'timeout'
+    if isinstance(error, (ConnectionResetError, aiohttp.ServerDisconnectedError)) or \
+            getattr(error, 'errno', None) == errno.ECONNRESET:
+        return 'reset'
+    if isinstance(error, ConnectionRefusedError):
+        return 'refused'
+    if isinstance(error, (ValueError, aiohttp.ClientResponseError, aiohttp.ClientPayloadError)):
+        return 'bad_response'
+    return 'error'
+
+async def start_metrics_server(metrics: ScanMetrics, port: int):
+    """Serve metrics.render() at http://127.0.0.1:port/metrics; returns the AppRunner."""
+    from aiohttp import web
+
+    async def scrape(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8',
+                            headers={'X-Content-Type-Options': 'nosniff'})
+
+    app = web.Application()
+    app.router.add_get('/metrics', scrape)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '127.0.0.1', port).start()
+    return runner
+
+# ========== PROFILING ==========
+class StageProfiler:
+    """Per-stage wall and CPU totals for profiling mode; stage() is a shared no-op while it is off."""
+    OFF = contextlib.nullcontext()
+
+    def __init__(self, mode: str = "off"):
+        self.mode = mode
+        self.lock = threading.Lock()
+        self.stages = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.mode != "off"
+
+    def add(self, name: str, wall: float, cpu: Optional[float] = None) -> None:
+        with self.lock:
+            calls, total_wall, total_cpu = self.stages.get(name, (0, 0.0, None))
+            if cpu is not None:
+                total_cpu = (total_cpu or 0.0) + cpu
+            self.stages[name] = (calls + 1, total_wall + wall, total_cpu)
+
+    def stage(self, name: str):
+        return self._timed(name) if self.enabled else self.OFF
+
+    @contextlib.contextmanager
+    def _timed(self, name: str) -> Iterator[None]:
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - wall, time.thread_time() - cpu)
+
+    def timed_iter(self, name: str, items: Iterable) -> Iterator:
+        """Charge the time spent producing each item of `items` to `name`."""
+        if not self.enabled:
+            yield from items
+            return
+        iterator = iter(items)
+        while True:
+            with self._timed(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def report(self, wall: float, cpu: float) -> dict:
+        with self.lock:
+            stages, self.stages = self.stages, {}
+        return {
+            'wall_seconds': round(wall, 3),
+            'cpu_seconds': round(cpu, 3),
+            'stages': {name: {'calls': calls,
+                              'wall_seconds': round(total_wall, 3),
+                              'cpu_seconds': round(total_cpu, 3) if total_cpu is not None else None}
+                       for name, (calls, total_wall, total_cpu) in sorted(stages.items(), key=lambda s: -s[1][1])}
+        }
+
+# ========== SCAN ORDER ==========
+class FeistelPermutation:
+    """Keyed, stateless bijection over range(size): a Feistel network with cycle-walking."""
+    ROUNDS = 4
+
+    def __init__(self, size: int, seed: int):
+        self.size = size
+        bits = max(2, (size - 1).bit_length())
+        bits += bits & 1
+        self.half_bits = bits // 2
+        self.half_mask = (1 << self.half_bits) - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(32) for _ in range(self.ROUNDS)]
+
+    def __len__(self) -> int:
+        return self.size
+
+    def _round(self, value: int, key: int) -> int:
+        value = (value * 0x9E3779B1 + key) & 0xFFFFFFFF
+        value ^= value >> 15
+        value = (value * 0x85EBCA6B) & 0xFFFFFFFF
+        value ^= value >> 13
+        return value & self.half_mask
+
+    def _encrypt(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.half_mask
+        for key in self.keys:
+            left, right = right, left ^ self._round(right, key)
+        return (left << self.half_bits) | right
+
+    def __getitem__(self, index: int) -> int:
+        if not 0 <= index < self.size:
+            raise IndexError(index)
+        value = self._encrypt(index)
+        while value >= self.size:
+            value = self._encrypt(value)
+        return value
+
+class AdaptiveLimiter:
+    """AIMD window over in-flight connects, shrunk on local errors, loop lag or rising timeouts."""
+    def __init__(self, initial: int, maximum: int, lag: LoopLagWatcher, minimum: int = 10):
+        self.lag = lag
+        self.minimum = min(minimum, maximum)
+        self.maximum = maximum
+        self.window = float(max(self.minimum, initial))
+        self.in_flight = 0
+        self.outcomes = {}
+        self.timeout_baseline = None
+        self.last_adjust = time.monotonic()
+        self._condition = asyncio.Condition()
+
+    def start(self) -> None:
+        self.lag.start()
+        self.lag.take_peak()
+
+    def stop(self) -> None:
+        self.lag.stop()
+
+    async def acquire(self) -> None:
+        async with self._condition:
+            await self._condition.wait_for(lambda: self.in_flight < int(self.window))
+            self.in_flight += 1
+
+    def record(self, outcome: str) -> None:
+        """Count an outcome from a later stage, which holds no window slot."""
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+
+    async def release(self, outcome: str) -> None:
+        async with self._condition:
+            self.in_flight -= 1
+            self.record(outcome)
+            if time.monotonic() - self.last_adjust >= AIMD_INTERVAL:
+                self._adjust()
+            self._condition.notify(max(0, int(self.window) - self.in_flight))
+
+    def _adjust(self) -> None:
+        total = sum(self.outcomes.values())
+        if total < AIMD_MIN_SAMPLES:
+            return
+        timeout_rate = self.outcomes.get('timeout', 0) / total
+        congested = (self.outcomes.get('local', 0) > 0
+                     or self.lag.take_peak() > AIMD_MAX_LOOP_LAG
+                     or (self.timeout_baseline is not None
+                         and timeout_rate > self.timeout_baseline + AIMD_TIMEOUT_MARGIN))
+        if congested:
+            self.window = max(self.minimum, self.window * AIMD_DECREASE)
+        else:
+            self.window = min(self.maximum, self.window + AIMD_INCREASE)
+        if self.timeout_baseline is None:
+            self.timeout_baseline = timeout_rate
+        else:
+            self.timeout_baseline = 0.8 * self.timeout_baseline + 0.2 * timeout_rate
+        self.outcomes = {}
+        self.last_adjust = time.monotonic()
+
+
+def fd_budget(wanted: int) -> int:
+    """Sockets we can hold open, raising the soft RLIMIT_NOFILE towards `wanted` if allowed."""
+    if resource is None:
+        return wanted
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    target = wanted + FD_HEADROOM
+    if soft != resource.RLIM_INFINITY and soft < target:
+        new_soft = target if hard == resource.RLIM_INFINITY else min(target, hard)
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (new_soft, hard))
+            soft = new_soft
+        except (ValueError, OSError):
+            pass
+    if soft == resource.RLIM_INFINITY:
+        return wanted
+    return max(1, soft - FD_HEADROOM)
+
+
+class ScanCursor:
+    """Low watermark over out-of-order probe completions; every counter below `position` has finished."""
+    def __init__(self, start: int = 0, step: int = 1):
+        self.position = start
+        self.step = step
+        self._done = set()
+
+    def complete(self, counter: int) -> None:
+        if counter != self.position:
+            self._done.add(counter)
+            return
+        self.position += self.step
+        while self.position in self._done:
+            self._done.remove(self.position)
+            self.position += self.step
+
+# ========== RANGE INDEX ==========
+class RangeIndex:
+    """Sorted, merged IPv4 intervals in packed arrays; offsets[i] counts the addresses before interval i."""
+    MAGIC = b'RIX1'
+    HEADER = struct.Struct('<4sIdQ')
+
+    def __init__(self, starts, ends, offsets, total: int, mtime: float = 0.0):
+        self.starts = starts
+        self.ends = ends
+        self.offsets = offsets
+        self.total = total
+        self.mtime = mtime
+        self._mmap = None
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __contains__(self, ip) -> bool:
+        value = ip if isinstance(ip, int) else int(ipaddress.IPv4Address(ip))
+        i = bisect.bisect_right(self.starts, value) - 1
+        return i >= 0 and value <= self.ends[i]
+
+    @classmethod
+    def from_intervals(cls, intervals: Iterable[Tuple[int, int]], mtime: float = 0.0) -> 'RangeIndex':
+        starts, ends = array('I'), array('I')
+        for start, end in sorted(intervals):
+            if ends and start <= ends[-1] + 1:
+                if end > ends[-1]:
+                    ends[-1] = end
+            else:
+                starts.append(start)
+                ends.append(end)
+        offsets = array('Q')
+        total = 0
+        for start, end in zip(starts, ends):
+            offsets.append(total)
+            total += end - start + 1
+        return cls(starts, ends, offsets, total, mtime)
+
+    @classmethod
+    def from_lines(cls, lines: Iterable[str], mtime: float = 0.0) -> 'RangeIndex':
+        intervals = []
+        for line in lines:
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            try:
+                net = ipaddress.IPv4Network(line, strict=False)
+            except ValueError:
+                continue
+            intervals.append((int(net.network_address), int(net.broadcast_address)))
+        return cls.from_intervals(intervals, mtime)
+
+    def intervals(self) -> List[Tuple[int, int]]:
+        return list(zip(self.starts, self.ends))
+
+    def address_at(self, position: int) -> int:
+        if not 0 <= position < self.total:
+            raise IndexError(position)
+        i = bisect.bisect_right(self.offsets, position) - 1
+        return self.starts[i] + position - self.offsets[i]
+
+    def position_of(self, value: int) -> Optional[int]:
+        """Inverse of address_at; None if value is outside every interval."""
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i < 0 or value > self.ends[i]:
+            return None
+        return self.offsets[i] + value - self.starts[i]
+
+    def ip_at(self, position: int) -> str:
+        return str(ipaddress.IPv4Address(self.address_at(position)))
+
+    def union(self, other: 'RangeIndex') -> 'RangeIndex':
+        return RangeIndex.from_intervals(self.intervals() + other.intervals())
+
+    def difference(self, other: 'RangeIndex') -> 'RangeIndex':
+        result = []
+        cut = other.intervals()
+        j = 0
+        for start, end in self.intervals():
+            while j < len(cut) and cut[j][1] < start:
+                j += 1
+            k = j
+            while k < len(cut) and cut[k][0] <= end:
+                if cut[k][0] > start:
+                    result.append((start, cut[k][0] - 1))
+                start = max(start, cut[k][1] + 1)
+                k += 1
+            if start <= end:
+                result.append((start, end))
+        return RangeIndex.from_intervals(result)
+
+    def to_cidrs(self) -> List[str]:
+        cidrs = []
+        for start, end in zip(self.starts, self.ends):
+            cidrs.extend(str(net) for net in ipaddress.summarize_address_range(
+                ipaddress.IPv4Address(start), ipaddress.IPv4Address(end)))
+        return cidrs
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(self), self.mtime, self.total))
+            f.write(self.starts.tobytes())
+            f.write(self.ends.tobytes())
+            f.write(self.offsets.tobytes())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional['RangeIndex']:
+        if sys.byteorder != 'little':
+            return None
+        with open(path, 'rb') as f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return None
+        magic, count, mtime, total = cls.HEADER.unpack_from(mapped)
+        if magic != cls.MAGIC or len(mapped) != cls.HEADER.size + count * 16:
+            mapped.close()
+            return None
+        view = memoryview(mapped)
+        base = cls.HEADER.size
+        starts = view[base:base + count * 4].cast('I')
+        ends = view[base + count * 4:base + count * 8].cast('I')
+        offsets = view[base + count * 8:base + count * 16].cast('Q')
+        index = cls(starts, ends, offsets, total, mtime)
+        index._mmap = mapped
+        return index
+
+
+def load_range_index(path: str) -> RangeIndex:
+    """Return the compiled index for a range file, rebuilding it if the text changed."""
+    if not os.path.exists(path):
+        return RangeIndex.from_intervals([])
+    mtime = os.path.getmtime(path)
+    cache_path = f"{path}{RANGE_INDEX_SUFFIX}"
+    if os.path.exists(cache_path):
+        try:
+            index = RangeIndex.load(cache_path)
+            if index is not None and index.mtime == mtime:
+                return index
+        except (OSError, struct.error):
+            pass
+    with open(path) as f:
+        index = RangeIndex.from_lines(f, mtime)
+    try:
+        index.save(cache_path)
+    except OSError:
+        pass
+    return index
+
+# ========== GEOIP ==========
+def parse_address(text: str) -> int:
+    text = text.strip()
+    return int(text) if text.isdigit() else int(ipaddress.IPv4Address(text))
+
+class GeoIPTable:
+    """Memory-mapped IPv4 intervals mapped to (country, city, asn, isp) records."""
+    MAGIC = b'GEO1'
+    HEADER = struct.Struct('<4sIdI')
+
+    def __init__(self, starts, ends, record_ids, records: List[Tuple[str, ...]], mtime: float = 0.0):
+        self.starts = starts
+        self.ends = ends
+        self.record_ids = record_ids
+        self.records = records
+        self.mtime = mtime
+        self._mmap = None
+        self.lookup = functools.lru_cache(maxsize=GEOIP_CACHE_SIZE)(self._lookup)
+
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable[List[str]], mtime: float = 0.0) -> 'GeoIPTable':
+        entries = []
+        records = {}
+        for row in rows:
+            if len(row) < 3 or row[0].startswith('#'):
+                continue
+            try:
+                start, end = parse_address(row[0]), parse_address(row[1])
+            except ValueError:
+                continue
+            record = tuple(field.strip() for field in (row + [''] * 6)[2:6])
+            entries.append((start, end, records.setdefault(record, len(records))))
+        entries.sort()
+        starts, ends, record_ids = array('I'), array('I'), array('I')
+        for start, end, record_id in entries:
+            starts.append(start)
+            ends.append(end)
+            record_ids.append(record_id)
+        return cls(starts, ends, record_ids, list(records), mtime)
+
+    def _lookup(self, value: int) -> Optional[Tuple[str, ...]]:
+        i = bisect.bisect_right(self.starts, value) - 1
+        if i < 0 or value > self.ends[i]:
+            return None
+        return self.records[self.record_ids[i]]
+
+    def details(self, ip: str) -> dict:
+        country, city, asn, isp = self.lookup(int(ipaddress.IPv4Address(ip))) or ('', '', '', '')
+        return {
+            "country": country or "Unknown",
+            "city": city or "Unknown",
+            "isp": f"AS{asn} {isp}".strip() if asn else isp or "Unknown"
+        }
+
+    def save(self, path: str) -> None:
+        records = json.dumps(self.records).encode()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(self), self.mtime, len(records)))
+            f.write(self.starts.tobytes())
+            f.write(self.ends.tobytes())
+            f.write(self.record_ids.tobytes())
+            f.write(records)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> Optional['GeoIPTable']:
+        if sys.byteorder != 'little':
+            return None
+        with open(path, 'rb') as f:
+            try:
+                mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                return None
+        magic, count, mtime, records_len = cls.HEADER.unpack_from(mapped)
+        base = cls.HEADER.size
+        if magic != cls.MAGIC or len(mapped) != base + count * 12 + records_len:
+            mapped.close()
+            return None
+        view = memoryview(mapped)
+        starts = view[base:base + count * 4].cast('I')
+        ends = view[base + count * 4:base + count * 8].cast('I')
+        record_ids = view[base + count * 8:base + count * 12].cast('I')
+        records = [tuple(record) for record in json.loads(bytes(view[base + count * 12:]))]
+        table = cls(starts, ends, record_ids, records, mtime)
+        table._mmap = mapped
+        return table
+
+
+def load_geoip_table(path: str) -> Optional[GeoIPTable]:
+    """Return the compiled table for a GeoIP CSV, rebuilding it if the CSV changed."""
+    if not os.path.exists(path):
+        return None
+    mtime = os.path.getmtime(path)
+    cache_path = f"{path}{RANGE_INDEX_SUFFIX}"
+    if os.path.exists(cache_path):
+        try:
+            table = GeoIPTable.load(cache_path)
+            if table is not None and table.mtime == mtime:
+                return table
+        except (OSError, struct.error, ValueError):
+            pass
+    with open(path, newline='') as f:
+        delimiter = '\t' if '\t' in f.readline() else ','
+        f.seek(0)
+        table = GeoIPTable.from_rows(csv.reader(f, delimiter=delimiter), mtime)
+    try:
+        table.save(cache_path)
+    except OSError:
+        pass
+    return table
+
+# ========== PROBED ADDRESSES ==========
+class BloomFilter:
+    """Fixed-size Bloom filter over integers using double hashing."""
+    def __init__(self, capacity: int, error_rate: float = BLOOM_ERROR_RATE):
+        capacity = max(1, capacity)
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, value: int) -> Iterator[int]:
+        h1 = (value * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+        h2 = ((value ^ (h1 >> 29)) * 0xBF58476D1CE4E5B9) & 0xFFFFFFFFFFFFFFFF | 1
+        for i in range(self.hashes):
+            yield (h1 + i * h2) % self.size
+
+    def add(self, value: int) -> bool:
+        """Set the bits for value; returns False if they were all set already."""
+        added = False
+        for bit in self._positions(value):
+            byte, mask = bit >> 3, 1 << (bit & 7)
+            if not self.bits[byte] & mask:
+                self.bits[byte] |= mask
+                added = True
+        return added
+
+    def __contains__(self, value: int) -> bool:
+        return all(self.bits[bit >> 3] & (1 << (bit & 7)) for bit in self._positions(value))
+
+class ProbedAddresses:
+    """Addresses already targeted in a scan: a bitmap over `index`, a Bloom filter for the rest."""
+    def __init__(self, index: RangeIndex, expected: int):
+        self.index = index
+        self.bitmap = bytearray((index.total + 7) // 8)
+        self.outside = BloomFilter(expected)
+
+    def add(self, value: int) -> bool:
+        """Record an address; returns False if it was already recorded."""
+        position = self.index.position_of(value)
+        if position is None:
+            return self.outside.add(value)
+        byte, mask = position >> 3, 1 << (position & 7)
+        if self.bitmap[byte] & mask:
+            return False
+        self.bitmap[byte] |= mask
+        return True
+
+# ========== RANGE SCHEDULER ==========
+def format_interval(start: int, end: int) -> str:
+    """CIDR notation when the interval is a single network, otherwise first-last."""
+    first, last = ipaddress.IPv4Address(start), ipaddress.IPv4Address(end)
+    networks = list(ipaddress.summarize_address_range(first, last))
+    if len(networks) == 1:
+        return str(networks[0])
+    return f"{first}-{last}"
+
+
+def range_hit_rate(stats: Optional[Tuple[int, int]]) -> float:
+    probes, hits = stats or (0, 0)
+    return (hits + 1) / (probes + BANDIT_PRIOR_PROBES)
+
+
+class WeightedRangeSampler:
+    """O(1) address draws from a RangeIndex weighted by size and hit rate (Vose's alias method)."""
+    def __init__(self, index: RangeIndex, stats: Dict[str, Tuple[int, int]]):
+        self.index = index
+        weights = [(end - start + 1) * range_hit_rate(stats.get(format_interval(start, end)))
+                   for start, end in zip(index.starts, index.ends)]
+        count, total = len(weights), sum(weights)
+        scaled = [weight * count / total for weight in weights]
+        self.prob = array('d', [1.0] * count)
+        self.alias = array('I', range(count))
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            less, more = small.pop(), large.pop()
+            self.prob[less] = scaled[less]
+            self.alias[less] = more
+            scaled[more] -= 1 - scaled[less]
+            (small if scaled[more] < 1 else large).append(more)
+
+    def draw(self) -> int:
+        i = random.randrange(len(self.prob))
+        if random.random() >= self.prob[i]:
+            i = self.alias[i]
+        start = self.index.starts[i]
+        return start + random.randrange(self.index.ends[i] - start + 1)
+
+class RangeScheduler:
+    """Thompson-sampling bandit that spends a probe budget across the ranges of a RangeIndex."""
+    def __init__(self, index: RangeIndex, ports: List[int], stats: Dict[str, Tuple[int, int]],
+                 seed: int, budget: int = 0):
+        self.index = index
+        self.ports = ports
+        self.seed = seed
+        self.budget = budget
+        self.keys = [format_interval(start, end) for start, end in index.intervals()]
+        self.probes = [stats.get(key, (0, 0))[0] for key in self.keys]
+        self.hits = [stats.get(key, (0, 0))[1] for key in self.keys]
+        self.cursors = [0] * len(self.keys)
+        self.pending = {}
+        self._permutations = {}
+        self._samples = []
+        self._generation = [0] * len(self.keys)
+        self._stale = set(range(len(self.keys)))
+
+    def record(self, ip: str, success: bool) -> None:
+        arm = bisect.bisect_right(self.index.starts, int(ipaddress.IPv4Address(ip))) - 1
+        if arm < 0:
+            return
+        self.probes[arm] += 1
+        self.hits[arm] += success
+        self._stale.add(arm)
+        probes, hits = self.pending.get(arm, (0, 0))
+        self.pending[arm] = (probes + 1, hits + success)
+
+    def drain_pending(self) -> List[Tuple[str, int, int]]:
+        pending, self.pending = self.pending, {}
+        return [(self.keys[arm], probes, hits) for arm, (probes, hits) in pending.items()]
+
+    def _arm_size(self, arm: int) -> int:
+        return (self.index.ends[arm] - self.index.starts[arm] + 1) * len(self.ports)
+
+    def next_arm(self) -> Optional[int]:
+        """Arm with the best posterior sample; only arms chosen or updated since their last draw are redrawn."""
+        for arm in self._stale:
+            if self.cursors[arm] >= self._arm_size(arm):
+                continue
+            self._generation[arm] += 1
+            misses = self.probes[arm] - self.hits[arm]
+            score = random.betavariate(self.hits[arm] + 1, misses + BANDIT_PRIOR_PROBES)
+            heapq.heappush(self._samples, (-score, arm, self._generation[arm]))
+        self._stale.clear()
+        if len(self._samples) > 4 * len(self.keys):
+            self._samples = [sample for sample in self._samples if sample[2] == self._generation[sample[1]]]
+            heapq.heapify(self._samples)
+        while self._samples:
+            _, arm, generation = heapq.heappop(self._samples)
+            if generation == self._generation[arm] and self.cursors[arm] < self._arm_size(arm):
+                self._stale.add(arm)
+                return arm
+        return None
+
+    def iter_tasks(self) -> Iterator[Tuple[int, str, int]]:
+        counter = 0
+        while counter < self.budget:
+            arm = self.next_arm()
+            if arm is None:
+                return
+            permutation = self._permutations.get(arm)
+            if permutation is None:
+                permutation = FeistelPermutation(self._arm_size(arm), self.seed + arm)
+                self._permutations[arm] = permutation
+            for _ in range(min(BANDIT_ARM_BATCH, self.budget - counter)):
+                position = self.cursors[arm]
+                if position >= permutation.size:
+                    break
+                self.cursors[arm] += 1
+                ip_pos, port_idx = divmod(permutation[position], len(self.ports))
+                ip = str(ipaddress.IPv4Address(self.index.starts[arm] + ip_pos))
+                yield counter, ip, self.ports[port_idx]
+                counter += 1
+
+# ========== NEGATIVE CACHE ==========
+def endpoint_key(ip: str, port: int) -> int:
+    """Key of ip:port in the negative cache; port 0 stands for every port of the host."""
+    return (int(ipaddress.IPv4Address(ip)) << 16) | port
+
+def dead_reason(error: Exception) -> str:
+    """NEGATIVE_CACHE_TTL reason for a proxy check that raised `error`."""
+    kind = http_error_kind(error)
+    if kind == 'error' and getattr(error, 'errno', None) == errno.ECONNREFUSED:
+        kind = 'refused'
+    return kind if kind in NEGATIVE_CACHE_TTL else 'bad_response'
+
+class NegativeCache:
+    """Recently failed endpoints and hosts: sorted arrays from dead_endpoints plus an LRU of new failures."""
+    def __init__(self, keys: Optional[array] = None, expires: Optional[array] = None):
+        self.keys = keys if keys is not None else array('Q')
+        self.expires = expires if expires is not None else array('d')
+        self.recent = OrderedDict()
+
+    @classmethod
+    def load(cls, conn: sqlite3.Connection) -> 'NegativeCache':
+        keys, expires = array('Q'), array('d')
+        for key, expiry in conn.execute(
+                'SELECT endpoint, expires FROM dead_endpoints WHERE expires > ? ORDER BY endpoint',
+                (time.time(),)):
+            keys.append(key)
+            expires.append(expiry)
+        return cls(keys, expires)
+
+    def __len__(self) -> int:
+        return len(self.keys) + len(self.recent)
+
+    def expiry(self, key: int) -> float:
+        expiry = self.recent.get(key)
+        if expiry is None:
+            i = bisect.bisect_left(self.keys, key)
+            if i == len(self.keys) or self.keys[i] != key:
+                return 0.0
+            expiry = self.expires[i]
+        return expiry
+
+    def __contains__(self, endpoint: Tuple[str, int]) -> bool:
+        key = endpoint_key(*endpoint)
+        now = time.time()
+        return self.expiry(key) > now or self.expiry(key & ~0xffff) > now
+
+    def add(self, ip: str, port: int, reason: str) -> Tuple[int, float]:
+        key = endpoint_key(ip, port)
+        expiry = time.time() + NEGATIVE_CACHE_TTL[reason]
+        self.recent[key] = expiry
+        self.recent.move_to_end(key)
+        if len(self.recent) > NEGATIVE_CACHE_RECENT_SIZE:
+            self.recent.popitem(last=False)
+        return key, expiry
+
+class HostFailures:
+    """Failed-port counts of the HOST_FAILURE_CACHE_SIZE most recently failing hosts of one scan."""
+    TIMEOUT = 0x8000
+
+    def __init__(self, ports: int, size: int = HOST_FAILURE_CACHE_SIZE):
+        self.ports = ports
+        self.size = size
+        self.counts = OrderedDict()
+
+    def record(self, ip: str, reason: str) -> Optional[str]:
+        """Count a refused or timed-out port; returns the host's reason once every port failed."""
+        host = parse_address(ip)
+        count = (self.counts.pop(host, 0) | (self.TIMEOUT if reason == 'timeout' else 0)) + 1
+        if count & ~self.TIMEOUT == self.ports:
+            return 'timeout' if count & self.TIMEOUT else 'refused'
+        self.counts[host] = count
+        if len(self.counts) > self.size:
+            self.counts.popitem(last=False)
+        return None
+
+# ========== JUDGE SERVER ==========
+async def run_judge_server(host: str, port: int):
+    """Serve GET / with the request as this server saw it: client IP, headers and the caller's nonce.
+
+    Returns the started AppRunner; port 0 picks a free port.
+    """
+    from aiohttp import web
+
+    async def judge(request: web.Request) -> web.Response:
+        return web.json_response({
+            'status': 'ok',
+            'nonce': request.query.get('nonce', ''),
+            'client_ip': request.remote,
+            'headers': {name: ', '.join(request.headers.getall(name)) for name in request.headers}
+        })
+
+    app = web.Application()
+    app.router.add_get('/', judge)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+def judge_anonymity(origin_ip: str, echo: dict, sent: Dict[str, str]) -> str:
+    """Classify a proxy from the judge's echo of a request sent through it.
+
+    Headers we sent ourselves (the stealth X-Forwarded-For) only count if the
+    proxy changed them.
+    """
+    sent = {name.lower(): value for name, value in sent.items()}
+    headers = {name.lower(): value for name, value in echo.get('headers', {}).items()
+               if name.lower() != 'host' and sent.get(name.lower()) != value}
+    if origin_ip and any(origin_ip in value for value in headers.values()):
+        return "Transparent"
+    if any(name in headers for name in JUDGE_PROXY_HEADERS):
+        return "Anonymous"
+    return "Elite"
+
+# ========== PROXY QUERIES ==========
+class ProxyQuery:
+    """Filtered active proxies, fastest first, paged by the (speed, ip, port) keyset."""
+
+    COLUMNS = ('ip', 'port', 'protocol', 'anonymity', 'speed', 'p95_ms', 'jitter_ms',
+               'country', 'city', 'isp', 'last_checked')
+
+    def __init__(self, anonymity: Optional[str] = None, protocol: Optional[str] = None,
+                 max_age: Optional[float] = None, max_speed: Optional[int] = None):
+        self.anonymity = anonymity
+        self.protocol = protocol
+        self.max_age = max_age
+        self.max_speed = max_speed
+
+    def where(self) -> Tuple[str, list]:
+        conditions, params = ['is_active = 1', 'speed IS NOT NULL'], []
+        if self.anonymity:
+            conditions.append('anonymity = ?')
+            params.append(self.anonymity)
+        if self.protocol:
+            conditions.append('protocol = ?')
+            params.append(self.protocol)
+        if self.max_age is not None:
+            conditions.append('last_checked >= ?')
+            params.append(datetime.fromtimestamp(time.time() - self.max_age).strftime("%Y-%m-%d %H:%M:%S"))
+        if self.max_speed is not None:
+            conditions.append('speed <= ?')
+            params.append(self.max_speed)
+        return ' AND '.join(conditions), params
+
+    def count(self, conn: sqlite3.Connection) -> int:
+        where, params = self.where()
+        return conn.execute(f'SELECT COUNT(*) FROM proxies WHERE {where}', params).fetchone()[0]
+
+    def page(self, conn: sqlite3.Connection, after: Optional[Tuple[int, str, int]] = None,
+             limit: int = PROXY_PAGE_SIZE) -> List[tuple]:
+        """Up to `limit` rows (in COLUMNS order) following the keyset `after`."""
+        where, params = self.where()
+        if after is not None:
+            where += ' AND (speed, ip, port) > (?, ?, ?)'
+            params.extend(after)
+        return conn.execute(f'''
+            SELECT {', '.join(self.COLUMNS)}
+            FROM proxies LEFT JOIN latency_stats USING (ip, port)
+            WHERE {where}
+            ORDER BY speed, ip, port
+            LIMIT ?
+        ''', params + [limit]).fetchall()
+
+    def iter_rows(self, conn: sqlite3.Connection, batch: int = EXPORT_BATCH) -> Iterator[tuple]:
+        """Every matching row, fetched `batch` at a time; memory stays flat however large the table."""
+        after = None
+        while True:
+            rows = self.page(conn, after, batch)
+            yield from rows
+            if len(rows) < batch:
+                return
+            after = row_key(rows[-1])
+
+def row_key(row: tuple) -> Tuple[int, str, int]:
+    """Keyset position (speed, ip, port) of a ProxyQuery row."""
+    return row[4], row[0], row[1]
+
+def pac_entry(protocol: Optional[str], ip: str, port: int) -> str:
+    kind = {'SOCKS5': 'SOCKS5', 'SOCKS4': 'SOCKS'}.get(protocol, 'PROXY')
+    return f"{kind} {ip}:{port}"
+
+def write_proxies(rows: Iterable[tuple], f, fmt: str) -> int:
+    """Stream ProxyQuery rows to the open text file f in format fmt (see EXPORT_FORMATS); returns the row count."""
+    count = 0
+    if fmt == 'csv':
+        writer = csv.writer(f)
+        writer.writerow(ProxyQuery.COLUMNS)
+        for row in rows:
+            writer.writerow(row)
+            count += 1
+    elif fmt == 'jsonl':
+        for row in rows:
+            f.write(json.dumps(dict(zip(ProxyQuery.COLUMNS, row))) + "\n")
+            count += 1
+    elif fmt == 'txt':
+        for row in rows:
+            f.write(f"{row[0]}:{row[1]}\n")
+            count += 1
+    elif fmt == 'pac':
+        # Fastest first; the browser falls through the list and finally goes direct
+        f.write("function FindProxyForURL(url, host) {\n    return \"")
+        for row in rows:
+            f.write(pac_entry(row[2], row[0], row[1]) + "; ")
+            count += 1
+        f.write("DIRECT\";\n}\n")
+    else:
+        raise ValueError(f"Unknown export format {fmt}")
+    return count
+
+# ========== REVALIDATION ==========
+def next_revalidation(interval: float, failures: int, success: bool) -> Tuple[float, int, Optional[float]]:
+    """Return (interval, failures, delay) after one recheck; delay is None once a proxy is dropped.
+
+    Each success doubles the interval of a stable proxy up to REVALIDATE_MAX_INTERVAL.
+    A failure halves it and schedules a retry REVALIDATE_RETRY * 2**(failures - 1)
+    seconds later, and REVALIDATE_MAX_FAILURES failures in a row deactivate the proxy.
+    """
+    if success:
+        interval = min(REVALIDATE_MAX_INTERVAL, interval * REVALIDATE_GROWTH)
+        return interval, 0, interval * random.uniform(1 - REVALIDATE_JITTER, 1 + REVALIDATE_JITTER)
+    failures += 1
+    interval = max(REVALIDATE_MIN_INTERVAL, interval / REVALIDATE_GROWTH)
+    if failures >= REVALIDATE_MAX_FAILURES:
+        return interval, failures, None
+    return interval, failures, REVALIDATE_RETRY * 2 ** (failures - 1)
+
+class ProxyScanner:
+    def __init__(self, shard_worker: bool = False):
+        self.shard_worker = shard_worker
         self.stop_event = asyncio.Event()
         self.total_tests = 0
         self.completed_tests = 0
         self.start_time = 0
+        self.scan_seed = 0
+        self.last_progress = 0
         self.ports = DEFAULT_PORTS[:]
         self.timeout = DEFAULT_TIMEOUT
         self.concurrency_limit = DEFAULT_THREADS
+        self.processes = DEFAULT_PROCESSES
+        self.connect_timeout = DEFAULT_CONNECT_TIMEOUT
+        self.probe_engine = DEFAULT_PROBE_ENGINE
+        self.revalidate_rate = DEFAULT_REVALIDATE_RATE
+        self.judge_url = ""
+        self.metrics_port = 0
+        self.lag_watcher = LoopLagWatcher()
+        self.metrics = ScanMetrics(self.lag_watcher)
+        self.profiler = StageProfiler()
+        self.metrics_runner = None
+        self.judge_origin = None
+        self.raw_probe = RawProxyProbe(IRANIAN_TEST_SITES + [TEST_URL])
+        self.dead_hosts = OrderedDict()
+        self.geoip = None
+        self.negative_cache = NegativeCache()
+        self.latency_history = LatencyHistory()
+        self.host_failures = None
+        self.dead_forward = None
+        self.limiter = None
+        self.working_ranges = None
         self.debug_mode = False
-        self.debug_log = []
+        self.debug_log = RingBufferHandler(DEBUG_LOG_BUFFER)
+        self.logger, self.log_listener = setup_logging(
+            self.debug_log, None if shard_worker else DEBUG_LOG_FILE)
         self.scan_results = []
-        self.load_config()
-        self.setup_files()
-        self.setup_database()
+        self.conn = None
+        self.db_writer = None
         self.session = None
+        self.load_config()
+        if not shard_worker:
+            self.setup_files()
+            self.setup_database()
+        elif os.path.exists(DATABASE_FILE):
+            self.load_negative_cache()
 
-    def log_debug(self, message: str) -> None:
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")[:-3]
-        debug_msg = f"[DEBUG][{timestamp}] {message}"
-        self.debug_log.append(debug_msg)
+    def log_debug(self, message: str, *args) -> None:
+        # Formatting is deferred to the logging thread and skipped entirely when debug is off
         if self.debug_mode:
-            print(f"{Colors.MAGENTA}{debug_msg}{Colors.RESET}")
+            with self.profiler.stage('logging'):
+                self.logger.debug(message, *args)
 
     def setup_files(self) -> None:
         try:
@@ -94,9 +1591,9 @@ class ProxyScanner:
 
     def setup_database(self) -> None:
         try:
-            self.conn = sqlite3.connect(DATABASE_FILE)
+            self.conn = sqlite3.connect(DATABASE_FILE, timeout=30)
+            configure_connection(self.conn)
             self.cursor = self.conn.cursor()
-            self.cursor.execute('PRAGMA journal_mode=WAL')
             
             self.cursor.execute('''
                 CREATE TABLE IF NOT EXISTS proxies (
@@ -119,18 +1616,156 @@ class ProxyScanner:
                     last_scan TEXT,
                     hit_rate REAL
                 )''')
+            columns = {row[1] for row in self.cursor.execute('PRAGMA table_info(ip_ranges)')}
+            for column in ('probes', 'hits'):
+                if column not in columns:
+                    self.cursor.execute(f'ALTER TABLE ip_ranges ADD COLUMN {column} INTEGER DEFAULT 0')
+            
+            columns = {row[1] for row in self.cursor.execute('PRAGMA table_info(proxies)')}
+            for column, decl in (('next_check', 'REAL'), ('check_interval', 'REAL'),
+                                 ('fail_count', 'INTEGER DEFAULT 0')):
+                if column not in columns:
+                    self.cursor.execute(f'ALTER TABLE proxies ADD COLUMN {column} {decl}')
             
             self.cursor.execute('''
                 CREATE INDEX IF NOT EXISTS idx_proxies_active 
                 ON proxies(is_active)
             ''')
+            # Keyset order plus the filter columns, so ProxyQuery pages and counts
+            # never sort and only visit the table for the rows they return
+            self.cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_proxies_speed
+                ON proxies(is_active, speed, ip, port, anonymity, protocol, last_checked)
+            ''')
+            
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS scan_runs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    scan_type TEXT,
+                    seed INTEGER,
+                    ports TEXT,
+                    targets TEXT,
+                    total INTEGER,
+                    cursor INTEGER DEFAULT 0,
+                    found INTEGER DEFAULT 0,
+                    status TEXT,
+                    started TEXT,
+                    updated TEXT
+                )''')
+            
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS scan_hits (
+                    run_id INTEGER,
+                    ip TEXT,
+                    port INTEGER,
+                    found_at TEXT,
+                    PRIMARY KEY (run_id, ip, port)
+                )''')
+            columns = {row[1] for row in self.cursor.execute('PRAGMA table_info(scan_hits)')}
+            if 'protocol' not in columns:
+                self.cursor.execute("ALTER TABLE scan_hits ADD COLUMN protocol TEXT DEFAULT 'HTTP'")
+            
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS work_units (
+                    run_id INTEGER,
+                    unit INTEGER,
+                    start INTEGER,
+                    end INTEGER,
+                    status TEXT DEFAULT 'pending',
+                    worker TEXT,
+                    lease_expires REAL,
+                    PRIMARY KEY (run_id, unit)
+                )''')
+            
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS latency_history (
+                    ip INTEGER,
+                    port INTEGER,
+                    at INTEGER,
+                    connect_us INTEGER,
+                    ttfb_us INTEGER,
+                    total_us INTEGER,
+                    PRIMARY KEY (ip, port, at)
+                ) WITHOUT ROWID''')
+            
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS latency_stats (
+                    ip TEXT,
+                    port INTEGER,
+                    p50_ms REAL,
+                    p95_ms REAL,
+                    jitter_ms REAL,
+                    connect_ms REAL,
+                    ttfb_ms REAL,
+                    samples INTEGER,
+                    PRIMARY KEY (ip, port)
+                )''')
+            
+            self.cursor.execute('''
+                CREATE TABLE IF NOT EXISTS dead_endpoints (
+                    endpoint INTEGER PRIMARY KEY,
+                    reason TEXT,
+                    expires REAL
+                )''')
+            self.cursor.execute('DELETE FROM dead_endpoints WHERE expires <= ?', (time.time(),))
             
             self.conn.commit()
+            self.negative_cache = NegativeCache.load(self.conn)
+            self.log_debug("Loaded %s recently dead endpoints", len(self.negative_cache))
+            self.latency_history = LatencyHistory.load(self.conn)
+            self.db_writer = DatabaseWriter(DATABASE_FILE, profiler=self.profiler)
+            self.db_writer.start()
             self.log_debug("Database initialized successfully")
         except sqlite3.Error as e:
             print(f"{Colors.RED}[!] Database error: {e}{Colors.RESET}")
             sys.exit(1)
 
+    def load_negative_cache(self) -> None:
+        """Read-only load for shard and distributed workers, which have no database of their own."""
+        try:
+            conn = sqlite3.connect(f"file:{DATABASE_FILE}?mode=ro", uri=True, timeout=30)
+            try:
+                self.negative_cache = NegativeCache.load(conn)
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            self.log_debug("Negative cache unavailable: %s", e)
+
+    def remember_dead(self, ip: str, port: int, reason: str) -> None:
+        """Skip ip:port in later probes and runs until NEGATIVE_CACHE_TTL[reason] expires."""
+        key, expiry = self.negative_cache.add(ip, port, reason)
+        self.persist_dead(key, reason, expiry)
+
+    def persist_dead(self, key: int, reason: str, expiry: Optional[float] = None) -> None:
+        if self.db_writer:
+            self.db_writer.submit(
+                'INSERT OR REPLACE INTO dead_endpoints (endpoint, reason, expires) VALUES (?, ?, ?)',
+                (key, reason, expiry or time.time() + NEGATIVE_CACHE_TTL[reason]))
+
+    def note_dead(self, ip: str, port: int, reason: str) -> None:
+        """Scan-stage failure: forwarded by shard and distributed workers, recorded otherwise."""
+        if self.dead_forward is not None:
+            self.dead_forward.append((ip, port, reason))
+        else:
+            self.record_dead(ip, port, reason)
+
+    def record_dead(self, ip: str, port: int, reason: str) -> None:
+        """Persist a scan failure for later runs without keeping it in memory.
+
+        Refused and timed-out ports only count towards their host; a host that
+        failed on every scanned port gets one entry covering all its ports.
+        """
+        if reason == 'bad_response':
+            self.persist_dead(endpoint_key(ip, port), reason)
+        elif self.host_failures is not None:
+            host_reason = self.host_failures.record(ip, reason)
+            if host_reason:
+                self.persist_dead(endpoint_key(ip, 0), host_reason)
+
+    def drain_dead(self) -> List[Tuple[str, int, str]]:
+        dead, self.dead_forward = self.dead_forward, []
+        return dead
+
     async def async_init(self) -> None:
         self.session = aiohttp.ClientSession(
             connector=aiohttp.TCPConnector(
@@ -141,19 +1776,39 @@ class ProxyScanner:
             headers=self.get_random_headers(),
             trust_env=True
         )
+        if self.metrics_port and not self.shard_worker:
+            try:
+                self.metrics_runner = await start_metrics_server(self.metrics, self.metrics_port)
+                self.lag_watcher.start()
+                self.log_debug("Metrics served at http://127.0.0.1:%s/metrics", self.metrics_port)
+            except OSError as e:
+                print(f"{Colors.YELLOW}[!] Metrics endpoint unavailable: {e}{Colors.RESET}")
         self.log_debug("Async session initialized")
 
     async def close(self) -> None:
         try:
             if self.session and not self.session.closed:
                 await self.session.close()
+            if self.metrics_runner:
+                self.lag_watcher.stop()
+                await self.metrics_runner.cleanup()
+                self.metrics_runner = None
+            if self.db_writer and self.db_writer.is_alive():
+                self.db_writer.stop()
             if self.conn:
                 self.conn.close()
             self.log_debug("Resources cleaned up")
+            if self.log_listener:
+                self.log_listener.stop()
+                self.log_listener = None
         except Exception as e:
             print(f"{Colors.YELLOW}[!] Cleanup error: {e}{Colors.RESET}")
 
     def get_random_headers(self) -> Dict[str, str]:
+        with self.profiler.stage('headers'):
+            return self._random_headers()
+
+    def _random_headers(self) -> Dict[str, str]:
         headers = {
             'User-Agent': random.choice(USER_AGENTS),
             'Accept': 'text/html,application/xhtml+xml',
@@ -163,7 +1818,7 @@ class ProxyScanner:
             'Accept-Encoding': 'gzip, deflate',
             'Cache-Control': random.choice(['no-cache', 'max-age=0'])
         }
-        self.log_debug(f"Generated headers: {headers}")
+        self.log_debug("Generated headers: %s", headers)
         return headers
 
     def load_config(self) -> None:
@@ -183,7 +1838,38 @@ class ProxyScanner:
                     threads = config.get('threads', DEFAULT_THREADS)
                     if isinstance(threads, int) and 10 <= threads <= 500:
                         self.concurrency_limit = threads
+                    
+                    connect_timeout = config.get('connect_timeout', DEFAULT_CONNECT_TIMEOUT)
+                    if isinstance(connect_timeout, (int, float)) and 0.1 <= connect_timeout <= 10:
+                        self.connect_timeout = connect_timeout
+                    
+                    processes = config.get('processes', DEFAULT_PROCESSES)
+                    if isinstance(processes, int) and 1 <= processes <= MAX_PROCESSES:
+                        self.processes = processes
+                    
+                    revalidate_rate = config.get('revalidate_rate', DEFAULT_REVALIDATE_RATE)
+                    if isinstance(revalidate_rate, (int, float)) and 0.1 <= revalidate_rate <= 1000:
+                        self.revalidate_rate = revalidate_rate
+                    
+                    profile = config.get('profile', "off")
+                    if profile in PROFILE_MODES:
+                        self.profiler.mode = profile
+                    
+                    metrics_port = config.get('metrics_port', 0)
+                    if isinstance(metrics_port, int) and (metrics_port == 0 or 1024 <= metrics_port <= 65535):
+                        self.metrics_port = metrics_port
+                    
+                    judge_url = config.get('judge_url', "")
+                    if isinstance(judge_url, str) and (not judge_url or judge_url.startswith('http://')):
+                        self.judge_url = judge_url
+                    
+                    probe_engine = config.get('probe_engine', DEFAULT_PROBE_ENGINE)
+                    if probe_engine in PROBE_ENGINES:
+                        self.probe_engine = probe_engine
                         
+            profile = os.environ.get(PROFILE_ENV, "").lower()
+            if profile:
+                self.profiler.mode = profile if profile in PROFILE_MODES else "timers"
             self.log_debug("Configuration loaded")
         except json.JSONDecodeError:
             print(f"{Colors.YELLOW}[!] Config file corrupted, using defaults{Colors.RESET}")
@@ -196,7 +1882,14 @@ class ProxyScanner:
                 json.dump({
                     'ports': self.ports,
                     'timeout': self.timeout,
-                    'threads': self.concurrency_limit
+                    'threads': self.concurrency_limit,
+                    'connect_timeout': self.connect_timeout,
+                    'probe_engine': self.probe_engine,
+                    'processes': self.processes,
+                    'revalidate_rate': self.revalidate_rate,
+                    'judge_url': self.judge_url,
+                    'metrics_port': self.metrics_port,
+                    'profile': self.profiler.mode
                 }, f, indent=2)
             self.log_debug("Configuration saved")
         except Exception as e:
@@ -210,7 +1903,7 @@ class ProxyScanner:
             'details': details,
             'status': status
         })
-        self.log_debug(f"Added scan result: {result_type} - {details} - {status}")
+        self.log_debug("Added scan result: %s - %s - %s", result_type, details, status)
 
     async def check_single_ip(self) -> None:
         clear_screen()
@@ -231,19 +1924,28 @@ class ProxyScanner:
             print(f"\n{Colors.YELLOW}[*] Testing {ip}:{port}...{Colors.RESET}")
             
             start_time = time.time()
-            success, _, _ = await self.check_proxy(ip, port)
+            protocol = await self.classify_proxy(ip, port)
             
-            if success:
-                print(f"\n{Colors.GREEN}[✓] Proxy {ip}:{port} is working!{Colors.RESET}")
-                self.add_scan_result("Single Proxy Check", f"{ip}:{port}", "Working")
+            if protocol:
+                print(f"\n{Colors.GREEN}[✓] Proxy {ip}:{port} is working ({protocol})!{Colors.RESET}")
+                self.add_scan_result("Single Proxy Check", f"{ip}:{port}", f"Working ({protocol})")
                 
                 proxy = f"{ip}:{port}"
-                proxy_result, speed, anonymity = await self.test_proxy_connection(proxy)
+                proxy_result, speed, anonymity = await self.test_proxy_connection(proxy, protocol)
                 
                 if speed is not None:
                     print(f"\n{Colors.CYAN}=== Detailed Results ==={Colors.RESET}")
                     print(f"Status: {Colors.GREEN}WORKING{Colors.RESET}")
+                    print(f"Protocol: {protocol}")
                     print(f"Speed: {speed}ms")
+                    self.db_writer.flush()
+                    latency = self.cursor.execute('''
+                        SELECT p50_ms, p95_ms, jitter_ms, connect_ms, ttfb_ms, samples
+                        FROM latency_stats WHERE ip = ? AND port = ?
+                    ''', (ip, port)).fetchone()
+                    if latency:
+                        print("Latency: p50 {:.1f}ms, p95 {:.1f}ms, jitter {:.1f}ms "
+                              "(connect {:.1f}ms, first byte {:.1f}ms, {} samples)".format(*latency))
                     print(f"Anonymity: {anonymity}")
                     
                     details = await self.get_proxy_details(ip)
@@ -252,7 +1954,7 @@ class ProxyScanner:
                     
                     save = input("\nSave to database? (y/n): ").strip().lower()
                     if save == 'y':
-                        self.save_to_database(proxy, speed, anonymity, details)
+                        self.save_to_database(proxy, speed, anonymity, details, protocol)
                         print(f"{Colors.GREEN}[✓] Saved to database{Colors.RESET}")
                 else:
                     print(f"\n{Colors.YELLOW}[!] Proxy responded but failed full test{Colors.RESET}")
@@ -291,131 +1993,138 @@ class ProxyScanner:
                     f.write(f"Status: {result['status']}\n\n")
                 
                 f.write("\n=== Current Working Proxies ===\n")
+                self.db_writer.flush()
                 try:
                     self.cursor.execute('SELECT COUNT(*) FROM proxies WHERE is_active = 1')
                     count = self.cursor.fetchone()[0]
                     f.write(f"Total working proxies in database: {count}\n\n")
                     
-                    self.cursor.execute('''
-                        SELECT ip, port, speed, anonymity, country, isp 
-                        FROM proxies 
-                        WHERE is_active = 1 
-                        ORDER BY speed ASC 
-                        LIMIT 100
-                    ''')
-                    proxies = self.cursor.fetchall()
-                    
-                    if proxies:
-                        f.write("Top 100 fastest proxies:\n")
-                        f.write("IP:Port\t\tSpeed\tAnonymity\tCountry\tISP\n")
+                    if count:
+                        f.write("Proxies, fastest first:\n")
+                        f.write("IP:Port\t\tProtocol\tSpeed\tAnonymity\tCountry\tISP\n")
                         f.write("-"*80 + "\n")
-                        for proxy in proxies:
-                            f.write(f"{proxy[0]}:{proxy[1]}\t{proxy[2]}ms\t{proxy[3]}\t{proxy[4]}\t{proxy[5]}\n")
+                        for ip, port, protocol, anonymity, speed, _, _, country, _, isp, _ in \
+                                ProxyQuery().iter_rows(self.conn):
+                            f.write(f"{ip}:{port}\t{protocol}\t{speed}ms\t{anonymity}\t{country}\t{isp}\n")
                     else:
                         f.write("No working proxies found in database\n")
                 except sqlite3.Error as e:
                     f.write(f"\nError accessing database: {str(e)}\n")
             
             print(f"{Colors.GREEN}[✓] Results saved to {RESULTS_FILE}{Colors.RESET}")
-            self.log_debug(f"Scan results saved to {RESULTS_FILE}")
+            self.log_debug("Scan results saved to %s", RESULTS_FILE)
         except IOError as e:
             print(f"{Colors.RED}[!] Error saving results: {e}{Colors.RESET}")
 
     def generate_targeted_ips(self, count: int) -> List[str]:
-        targets = set()
+        with self.profiler.stage('targets'):
+            return self._generate_targeted_ips(count)
+
+    def _generate_targeted_ips(self, count: int) -> List[str]:
+        targets = []
+        working_index = iran_index = RangeIndex.from_intervals([])
         
-        if os.path.exists(WORKING_RANGES_FILE):
-            try:
-                with open(WORKING_RANGES_FILE) as f:
-                    working_ranges = [line.strip() for line in f if line.strip()]
-                
-                self.log_debug(f"Found {len(working_ranges)} working ranges")
-                
-                for r in working_ranges[:50]:
-                    try:
-                        net = ipaddress.IPv4Network(r)
-                        targets.update(str(ip) for ip in net.hosts())
-                        if len(targets) >= count * 2:
-                            break
-                    except ValueError:
-                        continue
-            except IOError as e:
-                print(f"{Colors.YELLOW}[!] Error reading working ranges: {e}{Colors.RESET}")
-        
-        if os.path.exists(IP_RANGES_FILE):
-            try:
-                with open(IP_RANGES_FILE) as f:
-                    iran_ranges = [line.strip() for line in f if line.strip()]
-                    
-                self.log_debug(f"Found {len(iran_ranges)} Iranian IP ranges")
-                    
-                for r in random.sample(iran_ranges, min(10, len(iran_ranges))):
-                    try:
-                        net = ipaddress.IPv4Network(r)
-                        sample_size = min(50, len(list(net.hosts())))
-                        targets.update(
-                            str(ip) for ip in random.sample(list(net.hosts()), sample_size))
-                    except ValueError:
-                        continue
-            except IOError as e:
-                print(f"{Colors.YELLOW}[!] Error reading IP ranges: {e}{Colors.RESET}")
+        try:
+            working_index = load_range_index(WORKING_RANGES_FILE)
+            self.log_debug("Found %s working ranges", len(working_index))
+        except IOError as e:
+            print(f"{Colors.YELLOW}[!] Error reading working ranges: {e}{Colors.RESET}")
+        
+        try:
+            iran_index = load_range_index(IP_RANGES_FILE)
+            self.log_debug("Found %s Iranian IP ranges", len(iran_index))
+        except IOError as e:
+            print(f"{Colors.YELLOW}[!] Error reading IP ranges: {e}{Colors.RESET}")
+        
+        probed = ProbedAddresses(working_index.union(iran_index), count)
+        stats = self.load_range_stats()
+        
+        # Half the sample from ranges that produced proxies before, the rest from
+        # the Iranian ranges; duplicates are redrawn a few times before giving up
+        for index, quota in ((working_index, count // 2), (iran_index, count)):
+            if not index.total:
+                continue
+            sampler = WeightedRangeSampler(index, stats)
+            wanted = min(quota, count - len(targets))
+            for _ in range(wanted * SAMPLER_DRAW_ATTEMPTS):
+                if not wanted:
+                    break
+                value = sampler.draw()
+                if probed.add(value):
+                    targets.append(value)
+                    wanted -= 1
         
         while len(targets) < count:
-            targets.add(f"{random.randint(1, 223)}.{random.randint(0, 255)}."
-                      f"{random.randint(0, 255)}.{random.randint(1, 254)}")
+            value = (random.randint(1, 223) << 24) | random.randint(0, 0xFFFF) << 8 | random.randint(1, 254)
+            if probed.add(value):
+                targets.append(value)
         
-        result = random.sample(list(targets), min(count, len(targets)))
-        self.log_debug(f"Generated {len(result)} targeted IPs")
+        random.shuffle(targets)
+        result = [str(ipaddress.IPv4Address(value)) for value in targets[:count]]
+        self.log_debug("Generated %s targeted IPs", len(result))
         return result
 
+    async def fetch_via_proxy(self, ip: str, port: int, url: str) -> Tuple[int, Dict[str, str]]:
+        """GET url through ip:port with the configured probe engine; returns (status, headers)."""
+        if self.probe_engine == 'raw':
+            return await self.raw_probe.fetch(ip, port, url, self.timeout)
+        async with self.session.get(
+            url,
+            proxy=f"http://{ip}:{port}",
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            headers=self.get_random_headers()
+        ) as response:
+            return response.status, response.headers
+
+    def response_passes(self, ip: str, port: int, test_url: str, status: int, headers) -> bool:
+        status_ok = status in (200, 204, 404)
+        content_type = headers.get('content-type', '').lower()
+        server_header = headers.get('server', '').lower()
+        
+        self.log_debug("Response: status=%s, server=%s, content-type=%s", status, server_header, content_type)
+        
+        if any(x in server_header for x in ['apache', 'nginx', 'iis', 'litespeed']):
+            self.log_debug("Proxy %s:%s passed server header check", ip, port)
+            return True
+        
+        if 'digikala' in test_url:
+            result = status_ok and ('javascript' in content_type or 'text/html' in content_type)
+            self.log_debug("Digikala check result: %s", result)
+            return result
+        elif 'aparat' in test_url:
+            result = status == 404
+            self.log_debug("Aparat check result: %s", result)
+            return result
+        elif 'shahed' in test_url or 'yjc' in test_url:
+            lang = headers.get('content-language', '').lower()
+            result = 'fa-ir' in lang
+            self.log_debug("Language check result: %s (language: %s)", result, lang)
+            return result
+        
+        self.log_debug("Default status check: %s", status_ok)
+        return status_ok
+
     async def stealth_check(self, ip: str, port: int) -> bool:
         try:
             delay = random.uniform(0.1, 1.5)
-            self.log_debug(f"Testing {ip}:{port} with delay {delay:.2f}s")
+            self.log_debug("Testing %s:%s with delay %.2fs", ip, port, delay)
             await asyncio.sleep(delay)
             
             test_url = random.choice(IRANIAN_TEST_SITES)
-            proxy_url = f"http://{ip}:{port}"
-            self.log_debug(f"Using test URL: {test_url}")
+            self.log_debug("Using test URL: %s", test_url)
             
             try:
-                async with self.session.get(
-                    test_url,
-                    proxy=proxy_url,
-                    timeout=aiohttp.ClientTimeout(total=self.timeout),
-                    headers=self.get_random_headers()
-                ) as response:
-                    status_ok = response.status in (200, 204, 404)
-                    content_type = response.headers.get('content-type', '').lower()
-                    server_header = response.headers.get('server', '').lower()
-                    
-                    self.log_debug(f"Response: status={response.status}, server={server_header}, content-type={content_type}")
-                    
-                    if any(x in server_header for x in ['apache', 'nginx', 'iis', 'litespeed']):
-                        self.log_debug(f"Proxy {ip}:{port} passed server header check")
-                        return True
-                    
-                    if 'digikala' in test_url:
-                        result = status_ok and ('javascript' in content_type or 'text/html' in content_type)
-                        self.log_debug(f"Digikala check result: {result}")
-                        return result
-                    elif 'aparat' in test_url:
-                        result = response.status == 404
-                        self.log_debug(f"Aparat check result: {result}")
-                        return result
-                    elif 'shahed' in test_url or 'yjc' in test_url:
-                        lang = response.headers.get('content-language', '').lower()
-                        result = 'fa-ir' in lang
-                        self.log_debug(f"Language check result: {result} (language: {lang})")
-                        return result
-                    
-                    self.log_debug(f"Default status check: {status_ok}")
-                    return status_ok
-            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
-                self.log_debug(f"Proxy {ip}:{port} failed with error: {str(e)}")
+                status, headers = await self.fetch_via_proxy(ip, port, test_url)
+                with self.profiler.stage('classify'):
+                    passed = self.response_passes(ip, port, test_url, status, headers)
+                self.metrics.outcome('http', 'ok' if passed else 'bad_status')
+                return passed
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError, ValueError) as e:
+                self.log_debug("Proxy %s:%s failed with error: %s", ip, port, e)
+                self.metrics.outcome('http', http_error_kind(e))
                 return False
         except Exception as e:
-            self.log_debug(f"Unexpected error checking {ip}:{port}: {str(e)}")
+            self.log_debug("Unexpected error checking %s:%s: %s", ip, port, e)
             return False
 
     async def scan_for_open_proxies(self) -> None:
@@ -424,16 +2133,18 @@ class ProxyScanner:
         print(f"{Colors.GREEN}[1]{Colors.RESET} Scan Iranian IP ranges")
         print(f"{Colors.GREEN}[2]{Colors.RESET} Scan targeted IPs (recommended)")
         print(f"{Colors.GREEN}[3]{Colors.RESET} Quick scan working ranges")
+        print(f"{Colors.GREEN}[4]{Colors.RESET} Resume last scan")
+        print(f"{Colors.GREEN}[5]{Colors.RESET} Prioritised scan (by range hit rate)")
         
         choice = input("\nSelect scan type: ").strip()
         
+        index = None
         ip_list = []
         scan_type = ""
         if choice == "1":
             scan_type = "Iranian IP Ranges Scan"
             try:
-                with open(IP_RANGES_FILE) as f:
-                    all_ranges = [line.strip() for line in f if line.strip()]
+                all_ranges = load_range_index(IP_RANGES_FILE).intervals()
                 
                 if not all_ranges:
                     print(f"{Colors.RED}[!] No IP ranges found in {IP_RANGES_FILE}{Colors.RESET}")
@@ -451,22 +2162,17 @@ class ProxyScanner:
                         range_count = max(1, min(range_count, max_ranges))
                         
                     selected_ranges = random.sample(all_ranges, range_count)
-                    self.log_debug(f"Selected {range_count} IP ranges to scan")
+                    self.log_debug("Selected %s IP ranges to scan", range_count)
                     self.add_scan_result(scan_type, f"Scanning {range_count} IP ranges", "Started")
                     
                     print(f"{Colors.CYAN}[*] Scanning {range_count} IP ranges...{Colors.RESET}")
-                    
-                    for r in selected_ranges:
-                        try:
-                            net = ipaddress.IPv4Network(r)
-                            ip_list.extend(str(ip) for ip in net.hosts())
-                        except ValueError:
-                            continue
                             
                 except ValueError:
                     print(f"{Colors.RED}[!] Invalid input, using all ranges{Colors.RESET}")
                     range_count = max_ranges
                     selected_ranges = all_ranges
+                
+                index = RangeIndex.from_intervals(selected_ranges)
                     
             except Exception as e:
                 print(f"{Colors.RED}[!] Error: {e}{Colors.RESET}")
@@ -479,7 +2185,7 @@ class ProxyScanner:
                 count = int(input(f"IPs to scan (max {MAX_RANDOM_IPS}): "))
                 count = max(10, min(count, MAX_RANDOM_IPS))
                 ip_list = self.generate_targeted_ips(count)
-                self.log_debug(f"Generated {count} targeted IPs")
+                self.log_debug("Generated %s targeted IPs", count)
                 self.add_scan_result(scan_type, f"Scanning {count} targeted IPs", "Started")
             except ValueError:
                 print(f"{Colors.RED}[!] Invalid input{Colors.RESET}")
@@ -492,20 +2198,16 @@ class ProxyScanner:
                 return
             
             try:
-                with open(WORKING_RANGES_FILE) as f:
-                    ranges = [line.strip() for line in f if line.strip()]
+                ranges = load_range_index(WORKING_RANGES_FILE).intervals()
                 
-                self.log_debug(f"Found {len(ranges)} working ranges")
+                self.log_debug("Found %s working ranges", len(ranges))
                 self.add_scan_result(scan_type, f"Scanning {len(ranges)} working ranges", "Started")
                 
-                for r in ranges[:20]:
-                    try:
-                        net = ipaddress.IPv4Network(r)
-                        ip_list.extend(str(ip) for ip in net.hosts())
-                    except ValueError:
-                        continue
+                stats = self.load_range_stats()
+                ranges.sort(key=lambda r: -range_hit_rate(stats.get(format_interval(*r))))
+                index = RangeIndex.from_intervals(ranges[:20])
                         
-                if not ip_list:
+                if not index.total:
                     print(f"{Colors.RED}[!] No valid IPs in working ranges{Colors.RESET}")
                     self.add_scan_result(scan_type, "No valid IPs in working ranges", "Failed")
                     return
@@ -515,74 +2217,756 @@ class ProxyScanner:
                 self.add_scan_result(scan_type, "Initialization", f"Error: {str(e)}")
                 return
             
+        elif choice == "4":
+            await self.resume_last_scan()
+            return
+            
+        elif choice == "5":
+            await self.prioritised_scan()
+            return
+            
         else:
             print(f"{Colors.RED}[!] Invalid choice{Colors.RESET}")
             return
 
-        self.total_tests = len(ip_list) * len(self.ports)
-        self.completed_tests = 0
-        self.start_time = time.time()
-        self.log_debug(f"Starting scan of {len(ip_list)} IPs across {len(self.ports)} ports (total tests: {self.total_tests})")
-        
         try:
-            with open(OPEN_PROXIES_FILE, 'w'):
-                pass
-            self.log_debug("Cleared open proxies file")
+            with open(OPEN_PROXIES_FILE, 'w'):
+                pass
+            self.log_debug("Cleared open proxies file")
+        except IOError as e:
+            print(f"{Colors.RED}[!] Error clearing output file: {e}{Colors.RESET}")
+            self.add_scan_result(scan_type, "File operation", f"Error: {str(e)}")
+            return
+
+        targets = index if index is not None else ip_list
+        seed = random.getrandbits(63)
+        run_id = self.create_scan_run(scan_type, targets, seed, self.ports)
+        await self.run_scan(scan_type, targets, self.ports, seed, run_id)
+
+    async def resume_last_scan(self) -> None:
+        self.db_writer.flush()
+        try:
+            self.cursor.execute('''
+                SELECT id, scan_type, seed, ports, targets, cursor, total
+                FROM scan_runs
+                WHERE status != 'completed' AND scan_type NOT IN (?, ?)
+                ORDER BY id DESC
+                LIMIT 1
+            ''', (PRIORITISED_SCAN_TYPE, DISTRIBUTED_SCAN_TYPE))
+            row = self.cursor.fetchone()
+        except sqlite3.Error as e:
+            print(f"{Colors.RED}[!] Database error: {e}{Colors.RESET}")
+            return
+        
+        if not row:
+            print(f"{Colors.YELLOW}[!] No interrupted scan to resume{Colors.RESET}")
+            return
+        
+        run_id, scan_type, seed, ports_json, targets_json, position, total = row
+        targets = load_targets(json.loads(targets_json))
+        
+        self.cursor.execute('SELECT ip, port FROM scan_hits WHERE run_id = ?', (run_id,))
+        hits = self.cursor.fetchall()
+        try:
+            with open(OPEN_PROXIES_FILE, 'w') as f:
+                f.writelines(f"{ip}:{port}\n" for ip, port in hits)
+        except IOError as e:
+            print(f"{Colors.RED}[!] Error restoring output file: {e}{Colors.RESET}")
+            return
+        
+        print(f"{Colors.CYAN}[*] Resuming {scan_type} at {position}/{total} "
+              f"({len(hits)} proxies found so far){Colors.RESET}")
+        self.add_scan_result(scan_type, f"Resuming run {run_id} at {position}/{total}", "Started")
+        await self.run_scan(scan_type, targets, json.loads(ports_json), seed, run_id,
+                            start=position, found=len(hits))
+
+    async def prioritised_scan(self) -> None:
+        scan_type = PRIORITISED_SCAN_TYPE
+        index = load_range_index(IP_RANGES_FILE)
+        if not index.total:
+            print(f"{Colors.RED}[!] No IP ranges found in {IP_RANGES_FILE}{Colors.RESET}")
+            return
+        
+        try:
+            budget = int(input(f"Probe budget (1-{index.total * len(self.ports)}): ").strip())
+            budget = max(1, min(budget, index.total * len(self.ports)))
+        except ValueError:
+            print(f"{Colors.RED}[!] Invalid input{Colors.RESET}")
+            return
+        
+        try:
+            with open(OPEN_PROXIES_FILE, 'w'):
+                pass
+        except IOError as e:
+            print(f"{Colors.RED}[!] Error clearing output file: {e}{Colors.RESET}")
+            self.add_scan_result(scan_type, "File operation", f"Error: {str(e)}")
+            return
+        
+        seed = random.getrandbits(63)
+        scheduler = RangeScheduler(index, self.ports, self.load_range_stats(), seed, budget)
+        self.add_scan_result(scan_type, f"Spending {budget} probes over {len(index)} ranges", "Started")
+        run_id = self.create_scan_run(scan_type, index, seed, self.ports)
+        await self.run_scan(scan_type, index, self.ports, seed, run_id, scheduler=scheduler)
+
+    def load_range_stats(self) -> Dict[str, Tuple[int, int]]:
+        self.db_writer.flush()
+        try:
+            self.cursor.execute('SELECT range, probes, hits FROM ip_ranges')
+            return {key: (probes or 0, hits or 0) for key, probes, hits in self.cursor.fetchall()}
+        except sqlite3.Error as e:
+            print(f"{Colors.YELLOW}[!] Could not load range statistics: {e}{Colors.RESET}")
+            return {}
+
+    def save_range_stats(self, pending: List[Tuple[str, int, int]]) -> None:
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        for key, probes, hits in pending:
+            self.db_writer.submit('''
+                INSERT INTO ip_ranges (range, last_scan, hit_rate, probes, hits)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(range) DO UPDATE SET
+                    last_scan = excluded.last_scan,
+                    probes = probes + excluded.probes,
+                    hits = hits + excluded.hits,
+                    hit_rate = CAST(hits + excluded.hits AS REAL) / (probes + excluded.probes)
+            ''', (key, now, hits / probes, probes, hits))
+
+    def create_scan_run(self, scan_type: str, targets, seed: int, ports: List[int]) -> int:
+        stored = dump_targets(targets)
+        host_total = targets.total if isinstance(targets, RangeIndex) else len(targets)
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        self.cursor.execute('''
+            INSERT INTO scan_runs (scan_type, seed, ports, targets, total, status, started, updated)
+            VALUES (?, ?, ?, ?, ?, 'running', ?, ?)
+        ''', (scan_type, seed, json.dumps(ports), json.dumps(stored),
+              host_total * len(ports), now, now))
+        self.conn.commit()
+        self.log_debug("Created scan run %s", self.cursor.lastrowid)
+        return self.cursor.lastrowid
+
+    def checkpoint_scan_run(self, run_id: int, position: int, found: int, status: str = 'running') -> None:
+        self.db_writer.submit('''
+            UPDATE scan_runs SET cursor = ?, found = ?, status = ?, updated = ?
+            WHERE id = ?
+        ''', (position, found, status, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), run_id))
+
+    async def run_scan(self, scan_type: str, targets, ports: List[int], seed: int, run_id: int,
+                       start: int = 0, found: int = 0,
+                       scheduler: Optional['RangeScheduler'] = None) -> None:
+        if isinstance(targets, RangeIndex):
+            host_total = targets.total
+            ip_lookup = targets.ip_at
+        else:
+            host_total = len(targets)
+            ip_lookup = targets.__getitem__
+
+        self.scan_seed = seed
+        self.total_tests = host_total * len(ports)
+        self.completed_tests = start
+        self.start_time = time.time()
+        self.log_debug("Starting scan of %s IPs across %s ports (total tests: %s)", host_total, len(ports), self.total_tests)
+
+        self.host_failures = HostFailures(len(ports))
+        if scheduler is None and self.processes > 1:
+            try:
+                await self.run_sharded_scan(scan_type, targets, ports, seed, run_id, start, found)
+            finally:
+                self.host_failures = None
+            return
+        if scheduler is not None:
+            self.total_tests = scheduler.budget
+            tasks = scheduler.iter_tasks()
+        else:
+            tasks = iter_permuted_tasks(ip_lookup, host_total, ports, seed, start)
+            if isinstance(targets, RangeIndex):
+                scheduler = RangeScheduler(targets, ports, {}, seed)
+        tasks = self.profiler.timed_iter('targets', tasks)
+        self.log_debug("Created task stream (seed %s, start %s)", seed, start)
+
+        found_proxies = found
+        cursor = ScanCursor(start)
+        last_checkpoint = time.time()
+        probe, max_window = self.make_scan_probe()
+
+        async def handle_result(result: Tuple[int, Tuple[bool, str, int, Optional[str]]]) -> None:
+            with self.profiler.stage('persist'):
+                record_result(result)
+
+        def record_result(result: Tuple[int, Tuple[bool, str, int, Optional[str]]]) -> None:
+            nonlocal found_proxies, last_checkpoint
+            counter, (success, ip, port, protocol) = result
+            if success:
+                found_proxies += 1
+                try:
+                    self.record_hit(run_id, ip, port, protocol)
+                except IOError as e:
+                    print(f"{Colors.RED}[!] Error saving proxy: {e}{Colors.RESET}")
+                    self.add_scan_result(scan_type, f"Saving proxy {ip}:{port}", f"Error: {str(e)}")
+            cursor.complete(counter)
+            if scheduler is not None:
+                scheduler.record(ip, success)
+            if time.time() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                last_checkpoint = time.time()
+                self.checkpoint_scan_run(run_id, cursor.position, found_proxies)
+                if scheduler is not None:
+                    self.save_range_stats(scheduler.drain_pending())
+            self.report_progress("Found", found_proxies)
+
+        status = 'stopped'
+        profile = cProfile.Profile() if self.profiler.mode == "cprofile" else None
+        scan_wall, scan_cpu = time.perf_counter(), time.process_time()
+        self.limiter.start()
+        if profile:
+            profile.enable()
+        try:
+            if await self.run_worker_pool(tasks, probe, handle_result, workers=max_window):
+                status = 'completed'
+            else:
+                self.log_debug("Scan stopped by user")
+                self.add_scan_result(scan_type, "Scan progress", "Stopped by user")
+        finally:
+            if profile:
+                profile.disable()
+            self.limiter.stop()
+            self.limiter = None
+            self.host_failures = None
+            self.checkpoint_scan_run(run_id, cursor.position, found_proxies, status)
+            if scheduler is not None:
+                self.save_range_stats(scheduler.drain_pending())
+        self.report_progress("Found", found_proxies, force=True)
+        if self.profiler.enabled:
+            self.db_writer.flush()
+            self.report_profile(scan_type, run_id, time.perf_counter() - scan_wall,
+                                time.process_time() - scan_cpu, profile)
+
+        elapsed = time.time() - self.start_time
+        self.log_debug("Scan completed. Found %s proxies in %.2f seconds", found_proxies, elapsed)
+        self.add_scan_result(scan_type, "Scan completed", f"Found {found_proxies} proxies in {int(elapsed)}s")
+        print(f"\n{Colors.GREEN}[✓] Found {found_proxies} proxies in {int(elapsed)}s "
+              f"({int(found_proxies/max(1, elapsed))}/s){Colors.RESET}")
+
+    def record_hit(self, run_id: int, ip: str, port: int, protocol: str) -> None:
+        """Append a scan hit to OPEN_PROXIES_FILE and queue its scan_hits row; IOError propagates."""
+        self.db_writer.submit('''
+            INSERT OR IGNORE INTO scan_hits (run_id, ip, port, found_at, protocol)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (run_id, ip, port, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), protocol))
+        with open(OPEN_PROXIES_FILE, 'a') as f:
+            f.write(f"{ip}:{port}\n")
+        self.log_debug("Found open %s proxy: %s:%s", protocol, ip, port)
+
+    def report_profile(self, scan_type: str, run_id: int, wall: float, cpu: float,
+                       profile: Optional[cProfile.Profile] = None) -> None:
+        """Print the per-stage breakdown of the last scan and save it as PROFILE_FILE.json (and .prof)."""
+        report = self.profiler.report(wall, cpu)
+        path = PROFILE_FILE.format(run_id=run_id)
+        print(f"\n{Colors.CYAN}=== Profile: {wall:.1f}s wall, {cpu:.1f}s CPU ==={Colors.RESET}")
+        print(f"{'Stage':<16} {'Calls':>9} {'Wall s':>10} {'CPU s':>9}")
+        for name, stage in report['stages'].items():
+            stage_cpu = f"{stage['cpu_seconds']:.3f}" if stage['cpu_seconds'] is not None else "-"
+            print(f"{name:<16} {stage['calls']:>9} {stage['wall_seconds']:>10.3f} {stage_cpu:>9}")
+        print(f"{Colors.YELLOW}Probe stages overlap across concurrent probes, so their wall time "
+              f"can exceed the scan's{Colors.RESET}")
+        try:
+            with open(f"{path}.json", 'w') as f:
+                json.dump(dict(report, run_id=run_id, scan_type=scan_type), f, indent=2)
+            if profile:
+                profile.dump_stats(f"{path}.prof")
+                pstats.Stats(profile).sort_stats('cumulative').print_stats(15)
         except IOError as e:
-            print(f"{Colors.RED}[!] Error clearing output file: {e}{Colors.RESET}")
-            self.add_scan_result(scan_type, "File operation", f"Error: {str(e)}")
-            return
+            print(f"{Colors.RED}[!] Error saving profile: {e}{Colors.RESET}")
+        summary = ", ".join(f"{name} {stage['wall_seconds']}s" for name, stage in report['stages'].items())
+        self.add_scan_result(scan_type, "Profile", f"{wall:.1f}s wall, {cpu:.1f}s CPU; {summary}")
 
-        tasks = [(ip, port) for ip in ip_list for port in self.ports]
-        random.shuffle(tasks)
-        self.log_debug("Created randomized task list")
+    def make_scan_probe(self) -> Tuple[Callable[[Tuple[int, str, int]], Awaitable[Any]], int]:
+        """Build the two-stage (connect, then protocol check) scan probe and its worker count.
 
-        found_proxies = 0
-        batch_size = self.concurrency_limit * 10
-        
-        for i in range(0, len(tasks), batch_size):
-            if self.stop_event.is_set():
-                self.log_debug("Scan stopped by user")
-                self.add_scan_result(scan_type, "Scan progress", "Stopped by user")
-                break
-                
-            batch = tasks[i:i+batch_size]
-            self.log_debug(f"Processing batch {i//batch_size + 1} with {len(batch)} tasks")
-            
-            results = await asyncio.gather(*[self.check_proxy(ip, port) for ip, port in batch])
-            
-            for success, ip, port in results:
-                if success:
+        The probe returns (counter, (success, ip, port, protocol)) and never
+        raises, so every counter reaches the caller's ScanCursor.
+
+        Installs a fresh AdaptiveLimiter as self.limiter; the caller starts it, and stops
+        and clears it when the scan ends so later progress lines show no stale window.
+        """
+        http_slots = asyncio.Semaphore(self.concurrency_limit)
+        # An HTTP slot holds the stage-one socket plus at most one reconnect or CONNECT check
+        http_sockets = 2 * self.concurrency_limit
+        wanted = self.concurrency_limit * CONNECT_CONCURRENCY_FACTOR
+        max_window = max(1, min(wanted, fd_budget(wanted + http_sockets) - http_sockets))
+        self.limiter = AdaptiveLimiter(min(self.concurrency_limit, max_window), max_window,
+                                       self.lag_watcher)
+
+        async def probe(task: Tuple[int, str, int]) -> Tuple[int, Tuple[bool, str, int, Optional[str]]]:
+            counter, ip, port = task
+            if (ip, port) in self.negative_cache:
+                self.metrics.outcome('connect', 'cached')
+                return counter, (False, ip, port, None)
+            await self.limiter.acquire()
+            self.metrics.probe_started()
+            streams = None
+            http_slot = False
+            try:
+                outcome = 'error'
+                try:
+                    started = time.perf_counter()
+                    outcome, streams = await self.tcp_open(ip, port)
+                    elapsed = time.perf_counter() - started
+                    self.metrics.observe('connect', elapsed)
+                    self.metrics.outcome('connect', outcome)
+                    if self.profiler.enabled:
+                        self.profiler.add('probe_connect', elapsed)
+                    if streams:
+                        # The open socket keeps its window slot until an HTTP slot frees
+                        await http_slots.acquire()
+                        http_slot = True
+                finally:
+                    await self.limiter.release(outcome)
+                if outcome in ('refused', 'timeout'):
+                    self.note_dead(ip, port, outcome)
+                if outcome != 'open':
+                    return counter, (False, ip, port, None)
+                started = time.perf_counter()
+                try:
+                    protocol = await self.classify_proxy(ip, port, streams)
+                except OSError as e:
+                    # Running out of sockets says nothing about the endpoint: back off, cache nothing
+                    self.log_debug("Classifying %s:%s failed locally: %s", ip, port, e)
+                    self.limiter.record('local')
+                    self.metrics.outcome('http', 'local')
+                    return counter, (False, ip, port, None)
+                elapsed = time.perf_counter() - started
+                self.metrics.observe('http', elapsed)
+                if self.profiler.enabled:
+                    self.profiler.add('probe_http', elapsed)
+                if protocol:
+                    self.metrics.hit(port)
+                else:
+                    self.note_dead(ip, port, 'bad_response')
+                return counter, (protocol is not None, ip, port, protocol)
+            except Exception as e:
+                # A failed result still completes its counter, so the scan cursor keeps advancing
+                self.log_debug("Probe of %s:%s failed: %s", ip, port, e)
+                return counter, (False, ip, port, None)
+            finally:
+                if http_slot:
+                    http_slots.release()
+                if streams:
+                    streams[1].close()
+                self.metrics.probe_finished()
+
+        return probe, max_window
+
+    async def run_sharded_scan(self, scan_type: str, targets, ports: List[int], seed: int, run_id: int,
+                               start: int = 0, found: int = 0) -> None:
+        """Split one permutation across self.processes worker processes.
+
+        Shard k takes every processes-th counter starting at k, so the run's
+        checkpoint is the lowest shard cursor and resumes work the same way
+        with or without sharding.
+        """
+        shards = self.processes
+        context = multiprocessing.get_context('spawn')
+        results = context.Queue()
+        stop = context.Event()
+        stored = dump_targets(targets)
+        workers = [
+            context.Process(target=run_shard, name=f"scan-shard-{shard}",
+                            args=(shard, shards, stored, ports, seed, start, results, stop))
+            for shard in range(shards)
+        ]
+        for worker in workers:
+            worker.start()
+        self.log_debug("Started %s scan shards", shards)
+        print(f"{Colors.CYAN}[*] Scanning with {shards} processes...{Colors.RESET}")
+
+        found_proxies = found
+        shard_done = [0] * shards
+        shard_cursors = [start + ((shard - start) % shards) for shard in range(shards)]
+        finished = set()
+        last_checkpoint = time.time()
+        loop = asyncio.get_running_loop()
+        status = 'stopped'
+
+        def next_message():
+            try:
+                return results.get(timeout=PROGRESS_INTERVAL)
+            except queue.Empty:
+                return None
+
+        try:
+            while len(finished) < shards:
+                if self.stop_event.is_set():
+                    stop.set()
+                message = await loop.run_in_executor(None, next_message)
+                if message is None:
+                    if not any(worker.is_alive() for worker in workers):
+                        break
+                    continue
+                kind, shard = message[0], message[1]
+                if kind == 'hit':
+                    _, _, ip, port, protocol = message
                     found_proxies += 1
                     try:
-                        with open(OPEN_PROXIES_FILE, 'a') as f:
-                            f.write(f"{ip}:{port}\n")
-                        self.log_debug(f"Found open proxy: {ip}:{port}")
+                        self.record_hit(run_id, ip, port, protocol)
                     except IOError as e:
                         print(f"{Colors.RED}[!] Error saving proxy: {e}{Colors.RESET}")
-                        self.add_scan_result(scan_type, f"Saving proxy {ip}:{port}", f"Error: {str(e)}")
-            
-            self.completed_tests += len(batch)
-            elapsed = time.time() - self.start_time
-            print(f"{Colors.CYAN}\r[*] Progress: {self.completed_tests}/{self.total_tests} | "
-                  f"Speed: {int(self.completed_tests/max(1, elapsed))}/s | "
-                  f"Found: {found_proxies}{Colors.RESET}", end="")
+                elif kind in ('progress', 'done'):
+                    _, _, done, position, pending, dead = message
+                    shard_done[shard] = done
+                    shard_cursors[shard] = position
+                    self.save_range_stats(pending)
+                    for ip, port, reason in dead:
+                        self.record_dead(ip, port, reason)
+                    if kind == 'done':
+                        finished.add(shard)
+                self.completed_tests = start + sum(shard_done)
+                if time.time() - last_checkpoint >= CHECKPOINT_INTERVAL:
+                    last_checkpoint = time.time()
+                    self.checkpoint_scan_run(run_id, min(shard_cursors), found_proxies)
+                self.report_progress("Found", found_proxies)
+            if len(finished) == shards and not stop.is_set():
+                status = 'completed'
+        finally:
+            stop.set()
+            for worker in workers:
+                worker.join(timeout=self.timeout * (MAX_RETRIES + 1) + 5)
+                if worker.is_alive():
+                    worker.terminate()
+            self.checkpoint_scan_run(run_id, min(shard_cursors), found_proxies, status)
+        self.report_progress("Found", found_proxies, force=True)
 
         elapsed = time.time() - self.start_time
-        self.log_debug(f"Scan completed. Found {found_proxies} proxies in {elapsed:.2f} seconds")
-        self.add_scan_result(scan_type, "Scan completed", f"Found {found_proxies} proxies in {int(elapsed)}s")
+        self.log_debug("Sharded scan finished (%s). Found %s proxies in %.2f seconds", status, found_proxies, elapsed)
+        self.add_scan_result(scan_type, f"Scan {status} ({shards} processes)", f"Found {found_proxies} proxies in {int(elapsed)}s")
         print(f"\n{Colors.GREEN}[✓] Found {found_proxies} proxies in {int(elapsed)}s "
               f"({int(found_proxies/max(1, elapsed))}/s){Colors.RESET}")
 
+    async def scan_shard(self, shard: int, shards: int, targets, ports: List[int], seed: int,
+                         start: int, results, stop) -> None:
+        """Worker-process side of run_sharded_scan: probe one shard and report to the parent."""
+        if isinstance(targets, RangeIndex):
+            host_total, ip_lookup = targets.total, targets.ip_at
+            recorder = RangeScheduler(targets, ports, {}, seed)
+        else:
+            host_total, ip_lookup = len(targets), targets.__getitem__
+            recorder = None
+        first = start + ((shard - start) % shards)
+        tasks = iter_permuted_tasks(ip_lookup, host_total, ports, seed, first, shards)
+        cursor = ScanCursor(first, shards)
+        probe, max_window = self.make_scan_probe()
+        self.dead_forward = []
+        done = 0
+        last_report = time.time()
+
+        async def watch_stop() -> None:
+            while not stop.is_set():
+                await asyncio.sleep(PROGRESS_INTERVAL)
+            self.stop_event.set()
+
+        async def handle_result(result: Tuple[int, Tuple[bool, str, int, Optional[str]]]) -> None:
+            nonlocal done, last_report
+            counter, (success, ip, port, protocol) = result
+            done += 1
+            cursor.complete(counter)
+            if recorder is not None:
+                recorder.record(ip, success)
+            if success:
+                results.put(('hit', shard, ip, port, protocol))
+            if time.time() - last_report >= PROGRESS_INTERVAL:
+                last_report = time.time()
+                results.put(('progress', shard, done, cursor.position,
+                             recorder.drain_pending() if recorder else [], self.drain_dead()))
+
+        watcher = asyncio.ensure_future(watch_stop())
+        self.limiter.start()
+        try:
+            await self.run_worker_pool(tasks, probe, handle_result, workers=max_window)
+        finally:
+            self.limiter.stop()
+            self.limiter = None
+            watcher.cancel()
+            results.put(('done', shard, done, cursor.position,
+                         recorder.drain_pending() if recorder else [], self.drain_dead()))
+
+    def prepare_distributed_run(self, unit_size: int) -> Optional[int]:
+        """Return the unfinished distributed run, or create one over all of IP_RANGES_FILE."""
+        self.cursor.execute('''
+            SELECT id FROM scan_runs
+            WHERE scan_type = ? AND status != 'completed'
+            ORDER BY id DESC LIMIT 1
+        ''', (DISTRIBUTED_SCAN_TYPE,))
+        row = self.cursor.fetchone()
+        if row:
+            return row[0]
+        
+        index = load_range_index(IP_RANGES_FILE)
+        if not index.total:
+            return None
+        run_id = self.create_scan_run(DISTRIBUTED_SCAN_TYPE, index, random.getrandbits(63), self.ports)
+        total = index.total * len(self.ports)
+        self.cursor.executemany('''
+            INSERT INTO work_units (run_id, unit, start, end) VALUES (?, ?, ?, ?)
+        ''', ((run_id, unit, begin, min(begin + unit_size, total))
+              for unit, begin in enumerate(range(0, total, unit_size))))
+        self.conn.commit()
+        return run_id
+
+    def lease_work_unit(self, run_id: int, worker: str) -> Optional[Tuple[int, int, int]]:
+        now = time.time()
+        self.cursor.execute('''
+            UPDATE work_units SET status = 'pending', worker = NULL
+            WHERE run_id = ? AND status = 'leased' AND lease_expires < ?
+        ''', (run_id, now))
+        self.cursor.execute('''
+            SELECT unit, start, end FROM work_units
+            WHERE run_id = ? AND status = 'pending'
+            ORDER BY unit LIMIT 1
+        ''', (run_id,))
+        row = self.cursor.fetchone()
+        if row:
+            self.cursor.execute('''
+                UPDATE work_units SET status = 'leased', worker = ?, lease_expires = ?
+                WHERE run_id = ? AND unit = ?
+            ''', (worker, now + LEASE_SECONDS, run_id, row[0]))
+        self.conn.commit()
+        return row
+
+    async def run_coordinator(self, host: str, port: int, unit_size: int) -> None:
+        """Serve lease-based work units of one distributed run to --worker nodes over HTTP."""
+        from aiohttp import web
+        
+        run_id = self.prepare_distributed_run(unit_size)
+        if run_id is None:
+            print(f"{Colors.RED}[!] No IP ranges found in {IP_RANGES_FILE}{Colors.RESET}")
+            return
+        self.cursor.execute('SELECT seed, ports, targets, total FROM scan_runs WHERE id = ?', (run_id,))
+        seed, ports_json, targets_json, total_probes = self.cursor.fetchone()
+        self.cursor.execute('SELECT COUNT(*) FROM scan_hits WHERE run_id = ?', (run_id,))
+        found = self.cursor.fetchone()[0]
+        job = {'run_id': run_id, 'seed': seed, 'ports': json.loads(ports_json),
+               'targets': json.loads(targets_json), 'lease_seconds': LEASE_SECONDS}
+        self.host_failures = HostFailures(len(job['ports']))
+        finished = asyncio.Event()
+
+        def unit_counts() -> Tuple[int, int]:
+            self.cursor.execute('''
+                SELECT COUNT(*), SUM(status = 'done') FROM work_units WHERE run_id = ?
+            ''', (run_id,))
+            total, done = self.cursor.fetchone()
+            return total, done or 0
+
+        async def get_job(request: web.Request) -> web.Response:
+            return web.json_response(job)
+
+        async def lease(request: web.Request) -> web.Response:
+            body = await request.json()
+            unit = self.lease_work_unit(run_id, body['worker'])
+            if unit is None:
+                total, done = unit_counts()
+                return web.json_response({'finished': done == total}, status=410 if done == total else 204)
+            self.log_debug("Leased unit %s to %s", unit[0], body['worker'])
+            return web.json_response({'unit': unit[0], 'start': unit[1], 'end': unit[2]})
+
+        async def heartbeat(request: web.Request) -> web.Response:
+            body = await request.json()
+            self.cursor.execute('''
+                UPDATE work_units SET lease_expires = ?
+                WHERE run_id = ? AND unit = ? AND worker = ? AND status = 'leased'
+            ''', (time.time() + LEASE_SECONDS, run_id, body['unit'], body['worker']))
+            self.conn.commit()
+            return web.json_response({'ok': self.cursor.rowcount == 1})
+
+        async def complete(request: web.Request) -> web.Response:
+            nonlocal found
+            body = await request.json()
+            self.cursor.execute('SELECT status FROM work_units WHERE run_id = ? AND unit = ?',
+                                (run_id, body['unit']))
+            row = self.cursor.fetchone()
+            if row is None or row[0] == 'done':
+                return web.json_response({'ok': False})
+            hits = [(hit[0], int(hit[1]), hit[2] if len(hit) > 2 else "HTTP") for hit in body.get('hits', [])]
+            for ip, hit_port, protocol in hits:
+                try:
+                    self.record_hit(run_id, ip, hit_port, protocol)
+                except IOError as e:
+                    print(f"{Colors.RED}[!] Error saving proxy: {e}{Colors.RESET}")
+            found += len(hits)
+            for ip, dead_port, reason in body.get('dead', []):
+                self.record_dead(ip, int(dead_port), reason)
+            self.cursor.execute('''
+                UPDATE work_units SET status = 'done', lease_expires = NULL
+                WHERE run_id = ? AND unit = ?
+            ''', (run_id, body['unit']))
+            self.conn.commit()
+            total, done = unit_counts()
+            print(f"{Colors.CYAN}\r[*] Units: {done}/{total} | Last: {body['worker']} "
+                  f"+{len(hits)} proxies{Colors.RESET}", end="")
+            if done == total:
+                self.checkpoint_scan_run(run_id, total_probes, found, 'completed')
+                finished.set()
+            return web.json_response({'ok': True})
+
+        app = web.Application()
+        app.router.add_get('/job', get_job)
+        app.router.add_post('/lease', lease)
+        app.router.add_post('/heartbeat', heartbeat)
+        app.router.add_post('/complete', complete)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        total, done = unit_counts()
+        print(f"{Colors.CYAN}[*] Coordinating run {run_id} on http://{host}:{port} "
+              f"({done}/{total} units done){Colors.RESET}")
+        try:
+            if done < total:
+                await finished.wait()
+            # Let polling workers see 410 before the endpoint disappears
+            await asyncio.sleep(LEASE_SECONDS / 10)
+            print(f"\n{Colors.GREEN}[✓] All work units of run {run_id} are done{Colors.RESET}")
+        finally:
+            await runner.cleanup()
+
+    async def run_distributed_worker(self, url: str) -> None:
+        """Lease work units from a coordinator, scan them and report hits until the run is done."""
+        url = url.rstrip('/')
+        worker = f"{os.uname().nodename if hasattr(os, 'uname') else 'node'}-{os.getpid()}"
+        async with self.session.get(f"{url}/job") as response:
+            job = await response.json()
+        targets = load_targets(job['targets'])
+        ports, seed = job['ports'], job['seed']
+        host_total = targets.total if isinstance(targets, RangeIndex) else len(targets)
+        ip_lookup = targets.ip_at if isinstance(targets, RangeIndex) else targets.__getitem__
+        print(f"{Colors.CYAN}[*] Worker {worker} joined run {job['run_id']}{Colors.RESET}")
+        
+        while not self.stop_event.is_set():
+            async with self.session.post(f"{url}/lease", json={'worker': worker}) as response:
+                if response.status == 410:
+                    break
+                if response.status == 204:
+                    await asyncio.sleep(job['lease_seconds'] / 10)
+                    continue
+                unit = await response.json()
+            
+            hits = []
+            self.dead_forward = []
+            probe, max_window = self.make_scan_probe()
+
+            async def handle_result(result: Tuple[int, Tuple[bool, str, int, Optional[str]]]) -> None:
+                _, (success, ip, port, protocol) = result
+                if success:
+                    hits.append((ip, port, protocol))
+
+            async def keep_lease() -> None:
+                while True:
+                    await asyncio.sleep(job['lease_seconds'] / 3)
+                    async with self.session.post(f"{url}/heartbeat",
+                                                 json={'worker': worker, 'unit': unit['unit']}):
+                        pass
+
+            tasks = islice(iter_permuted_tasks(ip_lookup, host_total, ports, seed, unit['start']),
+                           unit['end'] - unit['start'])
+            heartbeat = asyncio.ensure_future(keep_lease())
+            self.limiter.start()
+            try:
+                completed = await self.run_worker_pool(tasks, probe, handle_result, workers=max_window)
+            finally:
+                self.limiter.stop()
+                self.limiter = None
+                heartbeat.cancel()
+            if not completed:
+                break
+            async with self.session.post(f"{url}/complete", json={
+                'worker': worker, 'unit': unit['unit'], 'hits': hits, 'dead': self.drain_dead()
+            }):
+                pass
+            print(f"{Colors.GREEN}[+] Unit {unit['unit']} done, {len(hits)} proxies{Colors.RESET}")
+
+    async def run_worker_pool(self, tasks: Iterable, probe: Callable[[Any], Awaitable[Any]],
+                              handle_result: Callable[[Any], Awaitable[None]],
+                              workers: Optional[int] = None) -> bool:
+        """Keep `workers` (default concurrency_limit) probes in flight until tasks run out.
+
+        Returns False if the run was cut short by stop_event.
+        """
+        workers = workers or self.concurrency_limit
+        queue = asyncio.Queue(maxsize=workers * 2)
+        stopped = False
+
+        async def producer() -> None:
+            nonlocal stopped
+            for task in tasks:
+                if self.stop_event.is_set():
+                    stopped = True
+                    break
+                await queue.put(task)
+            for _ in range(workers):
+                await queue.put(None)
+
+        async def worker() -> None:
+            while True:
+                task = await queue.get()
+                if task is None:
+                    return
+                if self.stop_event.is_set():
+                    continue
+                try:
+                    result = await probe(task)
+                    self.completed_tests += 1
+                    await handle_result(result)
+                except Exception as e:
+                    self.log_debug("Worker error on %s: %s", task, e)
+
+        self.log_debug("Starting worker pool with %s workers", workers)
+        await asyncio.gather(producer(), *(worker() for _ in range(workers)))
+        return not (stopped or self.stop_event.is_set())
+
+    def report_progress(self, label: str, found: int, force: bool = False) -> None:
+        now = time.time()
+        if not force and now - self.last_progress < PROGRESS_INTERVAL:
+            return
+        self.last_progress = now
+        elapsed = now - self.start_time
+        print(f"{Colors.CYAN}\r[*] Progress: {self.completed_tests}/{self.total_tests} | "
+              f"Speed: {int(self.completed_tests/max(1, elapsed))}/s | "
+              + (f"Window: {int(self.limiter.window)} | " if self.limiter else "")
+              + f"{label}: {found}{Colors.RESET}", end="")
+
+    async def tcp_open(self, ip: str, port: int) -> Tuple[str, Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]]]:
+        """Stage-one probe: plain TCP handshake.
+
+        Returns (outcome, streams): outcome is 'open', 'refused', 'timeout',
+        'local' (we ran out of sockets, ports or buffers) or 'error', and the
+        streams of an open connection are handed to the caller to classify and close.
+
+        Hosts that blackholed an earlier port get DEAD_HOST_CONNECT_TIMEOUT, or the
+        connect timeout if that is shorter.
+        """
+        blackholed = ip in self.dead_hosts
+        timeout = min(DEAD_HOST_CONNECT_TIMEOUT, self.connect_timeout) if blackholed else self.connect_timeout
+        try:
+            streams = await asyncio.wait_for(asyncio.open_connection(ip, port), timeout)
+        except asyncio.TimeoutError:
+            if not blackholed:
+                self.dead_hosts[ip] = True
+                if len(self.dead_hosts) > DEAD_HOST_CACHE_SIZE:
+                    self.dead_hosts.popitem(last=False)
+            return 'timeout', None
+        except ConnectionRefusedError:
+            return 'refused', None
+        except OSError as e:
+            self.log_debug("Connect to %s:%s failed: %s", ip, port, e)
+            return ('local' if e.errno in LOCAL_ERRNOS else 'error'), None
+        
+        self.dead_hosts.pop(ip, None)
+        return 'open', streams
+
     async def check_proxy(self, ip: str, port: int) -> Tuple[bool, str, int]:
         for attempt in range(MAX_RETRIES + 1):
             try:
-                self.log_debug(f"Attempt {attempt + 1} for {ip}:{port}")
+                self.log_debug("Attempt %s for %s:%s", attempt + 1, ip, port)
                 if await self.stealth_check(ip, port):
-                    self.log_debug(f"Proxy {ip}:{port} verified")
+                    self.log_debug("Proxy %s:%s verified", ip, port)
                     return (True, ip, port)
             except Exception as e:
-                self.log_debug(f"Error checking {ip}:{port}: {str(e)}")
+                self.log_debug("Error checking %s:%s: %s", ip, port, e)
                 if attempt == MAX_RETRIES:
                     return (False, ip, port)
                 await asyncio.sleep(random.uniform(0.5, 1.5))
@@ -597,13 +2981,18 @@ class ProxyScanner:
         try:
             with open(OPEN_PROXIES_FILE) as f:
                 proxies = [line.strip() for line in f if line.strip()]
-            self.log_debug(f"Loaded {len(proxies)} proxies for testing")
+            self.log_debug("Loaded %s proxies for testing", len(proxies))
             self.add_scan_result("Proxy Testing", f"Loaded {len(proxies)} proxies", "Started")
         except IOError as e:
             print(f"{Colors.RED}[!] Error reading proxies: {e}{Colors.RESET}")
             self.add_scan_result("Proxy Testing", "File operation", f"Error: {str(e)}")
             return
 
+        fresh = [proxy for proxy in proxies if not self.is_recently_dead(proxy)]
+        if len(fresh) < len(proxies):
+            print(f"{Colors.YELLOW}[*] Skipping {len(proxies) - len(fresh)} proxies that failed recently{Colors.RESET}")
+            proxies = fresh
+
         if not proxies:
             print(f"{Colors.RED}[!] No proxies to test{Colors.RESET}")
             self.add_scan_result("Proxy Testing", "No proxies loaded", "Failed")
@@ -612,11 +3001,12 @@ class ProxyScanner:
         self.total_tests = len(proxies)
         self.completed_tests = 0
         self.start_time = time.time()
-        self.log_debug(f"Starting testing of {len(proxies)} proxies")
+        self.log_debug("Starting testing of %s proxies", len(proxies))
         
         try:
             with open(WORKING_PROXIES_FILE, 'w'), open(WORKING_RANGES_FILE, 'w'):
                 pass
+            self.working_ranges = set()
             self.log_debug("Cleared output files")
         except IOError as e:
             print(f"{Colors.RED}[!] Error clearing output files: {e}{Colors.RESET}")
@@ -624,77 +3014,381 @@ class ProxyScanner:
             return
 
         working_proxies = 0
-        batch_size = self.concurrency_limit * 5
-        
-        for i in range(0, len(proxies), batch_size):
-            if self.stop_event.is_set():
-                self.log_debug("Testing stopped by user")
-                self.add_scan_result("Proxy Testing", "Testing progress", "Stopped by user")
-                break
-                
-            batch = proxies[i:i+batch_size]
-            self.log_debug(f"Testing batch {i//batch_size + 1} with {len(batch)} proxies")
-            
-            results = await asyncio.gather(*[self.test_proxy_connection(proxy) for proxy in batch])
-            
-            for proxy, speed, anonymity in results:
-                if speed is not None:
-                    working_proxies += 1
-                    try:
-                        details = await self.get_proxy_details(proxy.split(':')[0])
-                        self.save_to_database(proxy, speed, anonymity, details)
-                        self.save_working_range(proxy.split(':')[0])
-                        
-                        with open(WORKING_PROXIES_FILE, 'a') as f:
-                            f.write(f"{proxy}\n")
-                        self.log_debug(f"Working proxy: {proxy} (speed: {speed}ms, anonymity: {anonymity})")
-                        self.add_scan_result("Proxy Testing", f"Working proxy: {proxy}", f"Speed: {speed}ms, Anonymity: {anonymity}")
-                    except Exception as e:
-                        print(f"{Colors.YELLOW}[!] Error processing proxy {proxy}: {e}{Colors.RESET}")
-                        self.add_scan_result("Proxy Testing", f"Processing proxy {proxy}", f"Error: {str(e)}")
-            
-            self.completed_tests += len(batch)
-            elapsed = time.time() - self.start_time
-            print(f"{Colors.CYAN}\r[*] Progress: {self.completed_tests}/{self.total_tests} | "
-                  f"Speed: {int(self.completed_tests/max(1, elapsed))}/s | "
-                  f"Working: {working_proxies}{Colors.RESET}", end="")
+
+        async def handle_result(result: Tuple[str, Optional[int], str]) -> None:
+            nonlocal working_proxies
+            proxy, speed, anonymity = result
+            if speed is not None:
+                working_proxies += 1
+                try:
+                    details = await self.get_proxy_details(proxy.split(':')[0])
+                    self.save_to_database(proxy, speed, anonymity, details, protocols.get(proxy, "HTTP"))
+                    self.save_working_range(proxy.split(':')[0])
+                    
+                    with open(WORKING_PROXIES_FILE, 'a') as f:
+                        f.write(f"{proxy}\n")
+                    self.log_debug("Working proxy: %s (speed: %sms, anonymity: %s)", proxy, speed, anonymity)
+                    self.add_scan_result("Proxy Testing", f"Working proxy: {proxy}", f"Speed: {speed}ms, Anonymity: {anonymity}")
+                except Exception as e:
+                    print(f"{Colors.YELLOW}[!] Error processing proxy {proxy}: {e}{Colors.RESET}")
+                    self.add_scan_result("Proxy Testing", f"Processing proxy {proxy}", f"Error: {str(e)}")
+            else:
+                ip, port = proxy.split(':')
+                # A failed test carries its failure reason where the anonymity would be
+                self.remember_dead(ip, int(port), anonymity)
+            self.report_progress("Working", working_proxies)
+
+        protocols = self.load_hit_protocols()
+
+        async def probe(proxy: str) -> Tuple[str, Optional[int], str]:
+            return await self.test_proxy_connection(proxy, protocols.get(proxy, "HTTP"))
+
+        if not await self.run_worker_pool(proxies, probe, handle_result):
+            self.log_debug("Testing stopped by user")
+            self.add_scan_result("Proxy Testing", "Testing progress", "Stopped by user")
+        self.report_progress("Working", working_proxies, force=True)
 
         elapsed = time.time() - self.start_time
-        self.log_debug(f"Testing completed. Found {working_proxies} working proxies in {elapsed:.2f} seconds")
+        self.log_debug("Testing completed. Found %s working proxies in %.2f seconds", working_proxies, elapsed)
         self.add_scan_result("Proxy Testing", "Testing completed", f"Found {working_proxies} working proxies in {int(elapsed)}s")
         print(f"\n{Colors.GREEN}[✓] Verified {working_proxies} working proxies in {int(elapsed)}s "
               f"({int(working_proxies/max(1, elapsed))}/s){Colors.RESET}")
 
-    async def test_proxy_connection(self, proxy: str) -> Tuple[str, Optional[int], str]:
+    async def revalidate_proxies(self, stop: asyncio.Event) -> None:
+        """Recheck active proxies from the database until `stop` is set.
+
+        Proxies sit in a heap keyed by next-check time and are rechecked at no
+        more than revalidate_rate per second; next_revalidation decides when each
+        one comes back. The table is re-read every REVALIDATE_RELOAD seconds so
+        proxies found meanwhile join the queue.
+        """
+        heap = []
+        state = {}
+        protocols = {}
+        in_flight = set()
+        slots = asyncio.Semaphore(self.concurrency_limit)
+        checked = alive = dropped = 0
+        next_reload = next_slot = 0.0
+
+        def reload() -> None:
+            self.db_writer.flush()
+            rows = self.cursor.execute('''
+                SELECT ip, port, next_check, check_interval, fail_count, protocol
+                FROM proxies WHERE is_active = 1
+            ''').fetchall()
+            for ip, port, next_check, interval, failures, protocol in rows:
+                key = (ip, port)
+                if key in state:
+                    continue
+                state[key] = (interval or REVALIDATE_MIN_INTERVAL, failures or 0)
+                protocols[key] = protocol if protocol in TUNNEL_PROTOCOLS else "HTTP"
+                heapq.heappush(heap, (next_check or 0.0, ip, port))
+            self.log_debug("Revalidation queue holds %s proxies", len(state))
+
+        async def recheck(ip: str, port: int) -> None:
+            nonlocal checked, alive, dropped
+            try:
+                _, speed, anonymity = await self.test_proxy_connection(f"{ip}:{port}", protocols[(ip, port)])
+            finally:
+                slots.release()
+            interval, failures = state[(ip, port)]
+            interval, failures, delay = next_revalidation(interval, failures, speed is not None)
+            checked += 1
+            now = time.time()
+            if speed is not None:
+                alive += 1
+                self.db_writer.submit('''
+                    UPDATE proxies SET speed = ?, anonymity = ?, last_checked = ?, is_active = 1,
+                        next_check = ?, check_interval = ?, fail_count = 0
+                    WHERE ip = ? AND port = ?
+                ''', (speed, anonymity, datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                      now + delay, interval, ip, port))
+            else:
+                self.db_writer.submit('''
+                    UPDATE proxies SET is_active = ?, next_check = ?, check_interval = ?, fail_count = ?
+                    WHERE ip = ? AND port = ?
+                ''', (int(delay is not None), now + (delay or 0), interval, failures, ip, port))
+            if delay is None:
+                dropped += 1
+                del state[(ip, port)]
+                self.log_debug("Deactivated %s:%s after %s failed checks", ip, port, failures)
+                return
+            state[(ip, port)] = (interval, failures)
+            heapq.heappush(heap, (now + delay, ip, port))
+
+        print(f"{Colors.CYAN}[*] Revalidating proxies at up to {self.revalidate_rate} checks/s{Colors.RESET}")
+        while not stop.is_set():
+            now = time.time()
+            if now >= next_reload:
+                reload()
+                next_reload = now + REVALIDATE_RELOAD
+            wait = next_reload - now
+            if heap:
+                wait = min(wait, heap[0][0] - now)
+            # Rechecks in flight push new entries, so never sleep past the next poll
+            wait = max(min(wait, PROGRESS_INTERVAL), next_slot - now)
+            if wait > 0:
+                try:
+                    await asyncio.wait_for(stop.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            if not heap:
+                continue
+            _, ip, port = heapq.heappop(heap)
+            await slots.acquire()
+            next_slot = time.time() + 1 / self.revalidate_rate
+            task = asyncio.create_task(recheck(ip, port))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+            print(f"{Colors.CYAN}\r[*] Queued: {len(state)} | Checked: {checked} | "
+                  f"Alive: {alive} | Deactivated: {dropped} | In flight: {len(in_flight)}{Colors.RESET}", end="")
+
+        if in_flight:
+            await asyncio.gather(*in_flight, return_exceptions=True)
+        self.db_writer.flush()
+        print(f"\n{Colors.GREEN}[✓] Ran {checked} rechecks: {alive} alive, {dropped} deactivated{Colors.RESET}")
+        self.add_scan_result("Revalidation", f"Ran {checked} rechecks", f"{alive} alive, {dropped} deactivated")
+
+    async def revalidate_until_enter(self) -> None:
+        stop = asyncio.Event()
+        print(f"{Colors.YELLOW}[*] Press Enter to stop{Colors.RESET}")
+        waiter = asyncio.get_running_loop().run_in_executor(None, input)
+        waiter.add_done_callback(lambda _: stop.set())
+        await self.revalidate_proxies(stop)
+
+    def is_recently_dead(self, proxy: str) -> bool:
+        ip, _, port = proxy.partition(':')
+        try:
+            return (ip, int(port)) in self.negative_cache
+        except ValueError:
+            return False
+
+    async def judge_origin_ip(self) -> str:
+        """Our own address as the judge sees it, fetched once without a proxy."""
+        if self.judge_origin is None:
+            try:
+                async with self.session.get(
+                    self.judge_url,
+                    timeout=aiohttp.ClientTimeout(total=self.timeout)
+                ) as response:
+                    self.judge_origin = (await response.json(content_type=None)).get('client_ip', '')
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                print(f"{Colors.YELLOW}[!] Judge {self.judge_url} unreachable: {e}{Colors.RESET}")
+                self.judge_origin = ''
+            self.log_debug("Judge sees us as %s", self.judge_origin or "unknown")
+        return self.judge_origin
+
+    async def judge_check(self, ip: str, port: int) -> Optional[Tuple[Tuple[float, float, float], str]]:
+        """One timed proxied request to the judge; returns ((connect, first byte, total), anonymity) or None."""
+        origin = await self.judge_origin_ip()
+        nonce = f"{random.getrandbits(64):016x}"
+        url = f"{self.judge_url.rstrip('/')}/?nonce={nonce}"
+        status, body, *timing = await self.raw_probe.timed_fetch(
+            ip, port, url, self.timeout, RawProxyProbe.render(url, random.choice(USER_AGENTS)))
+        if status != 200:
+            return None
+        try:
+            echo = json.loads(body)
+        except ValueError:
+            return None
+        if not isinstance(echo, dict) or echo.get('nonce') != nonce:
+            return None
+        # The raw request carries no proxy headers of ours, so any in the echo came from the proxy
+        return tuple(timing), judge_anonymity(origin, echo, {})
+
+    async def http_check(self, ip: str, port: int) -> Optional[Tuple[int, str]]:
+        """Validate an HTTP proxy; returns (p50 ms, anonymity) or None.
+
+        The validating request (judge, or TEST_URL plus detect_anonymity) is
+        timed and counts as the first latency sample. Timed requests use the raw
+        engine whatever probe_engine says, as aiohttp does not report connect
+        and first-byte times.
+        """
+        if self.judge_url:
+            checked = await self.judge_check(ip, port)
+        else:
+            status, _, *timing = await self.raw_probe.timed_fetch(ip, port, TEST_URL, self.timeout)
+            checked = (tuple(timing), await self.detect_anonymity(f"http://{ip}:{port}")) if status == 204 else None
+        if not checked:
+            return None
+        timing, anonymity = checked
+        p50, _, _ = await self.sample_latency(ip, port, timing)
+        return int(p50), anonymity
+
+    async def sample_latency(self, ip: str, port: int,
+                             first: Tuple[float, float, float]) -> Tuple[float, float, float]:
+        """Record the validating request `first` plus LATENCY_SAMPLES - 1 more timed requests.
+
+        Each sample is split into connect, first byte and total time and kept in
+        latency_history; p50/p95/jitter (ms) over the last LATENCY_HISTORY samples,
+        taken from self.latency_history, go to latency_stats and are returned.
+        """
+        url = self.judge_url or TEST_URL
+        key = int(ipaddress.IPv4Address(ip))
+        fresh = []
+
+        def record(timing) -> None:
+            connect, first_byte, total = timing
+            fresh.append((time.time_ns() // 1000, int(connect * 1e6), int(first_byte * 1e6), int(total * 1e6)))
+
+        record(first)
+        for _ in range(LATENCY_SAMPLES - 1):
+            try:
+                status, _, *timing = await self.raw_probe.timed_fetch(ip, port, url, self.timeout)
+            except (asyncio.TimeoutError, OSError, ValueError) as e:
+                self.log_debug("Latency sample for %s:%s failed: %s", ip, port, e)
+                continue
+            if status < 500:
+                record(timing)
+        
+        for sample in fresh:
+            self.db_writer.submit('''
+                INSERT OR REPLACE INTO latency_history (ip, port, at, connect_us, ttfb_us, total_us)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (key, port) + sample)
+        self.db_writer.submit('''
+            DELETE FROM latency_history WHERE ip = ? AND port = ? AND at <= (
+                SELECT at FROM latency_history WHERE ip = ? AND port = ?
+                ORDER BY at DESC LIMIT 1 OFFSET ?)
+        ''', (key, port, key, port, LATENCY_HISTORY))
+        
+        totals = self.latency_history.add(key, port, [sample[3] / 1000 for sample in fresh])
+        p50, p95, jitter = latency_summary(totals)
+        self.db_writer.submit('''
+            INSERT OR REPLACE INTO latency_stats (ip, port, p50_ms, p95_ms, jitter_ms, connect_ms, ttfb_ms, samples)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (ip, port, p50, p95, jitter,
+              percentile([sample[1] / 1000 for sample in fresh], 50),
+              percentile([sample[2] / 1000 for sample in fresh], 50), len(totals)))
+        self.log_debug("Latency for %s:%s: p50 %.1fms, p95 %.1fms, jitter %.1fms", ip, port, p50, p95, jitter)
+        return p50, p95, jitter
+
+    async def classify_proxy(self, ip: str, port: int,
+                             streams: Optional[Tuple[asyncio.StreamReader, asyncio.StreamWriter]] = None) -> Optional[str]:
+        """Protocol of a working proxy at ip:port, or None.
+
+        Openers go in PROBE_ORDER (SOCKS_PROBE_ORDER on SOCKS_PORTS), the first
+        on `streams` when the caller already holds a connection, and the first
+        reply decides. Only an endpoint that drops an opener gets the next one,
+        on a new connection; an HTTP reply that does not pass is tried once
+        more as a CONNECT tunnel. Classification always uses raw streams, since
+        an aiohttp session cannot take over an open socket.
+
+        Raises OSError for local socket errors (LOCAL_ERRNOS), which are not the endpoint's fault.
+        """
+        test_url = random.choice(IRANIAN_TEST_SITES)
+        # SOCKS handshakes get a few connect timeouts, which keeps tarpits from holding an HTTP slot
+        handshake = min(self.timeout, self.connect_timeout * FINGERPRINT_TIMEOUT_FACTOR)
+        for probe in SOCKS_PROBE_ORDER if port in SOCKS_PORTS else PROBE_ORDER:
+            owned = streams is None
+            if owned:
+                try:
+                    reader, writer = await asyncio.wait_for(asyncio.open_connection(ip, port),
+                                                            self.connect_timeout)
+                except (OSError, asyncio.TimeoutError) as e:
+                    if getattr(e, 'errno', None) in LOCAL_ERRNOS:
+                        raise
+                    self.log_debug("Reconnect to %s:%s failed: %s", ip, port, e)
+                    return None
+            else:
+                (reader, writer), streams = streams, None
+            try:
+                protocol, head = await asyncio.wait_for(
+                    self.raw_probe.identify(reader, writer, probe, test_url if probe == 'HTTP' else TEST_URL),
+                    self.timeout if probe == 'HTTP' else handshake)
+            except (TunnelRefused, asyncio.TimeoutError) as e:
+                self.log_debug("Proxy %s:%s refused or ignored %s: %s", ip, port, probe, e)
+                self.metrics.outcome('http', http_error_kind(e))
+                return None
+            except (OSError, ValueError, asyncio.IncompleteReadError, asyncio.LimitOverrunError) as e:
+                if getattr(e, 'errno', None) in LOCAL_ERRNOS:
+                    raise
+                self.log_debug("Proxy %s:%s dropped %s opener: %s", ip, port, probe, e)
+                continue
+            finally:
+                if owned:
+                    writer.close()
+            if protocol == 'HTTP':
+                status, headers = head
+                with self.profiler.stage('classify'):
+                    passed = probe == 'HTTP' and self.response_passes(ip, port, test_url, status, headers)
+                self.metrics.outcome('http', 'ok' if passed else 'bad_status')
+                if passed:
+                    return "HTTP"
+                protocol = await self.raw_probe.fingerprint(ip, port, handshake, ("CONNECT",))
+            if protocol:
+                self.log_debug("Proxy %s:%s speaks %s", ip, port, protocol)
+            return protocol
+        return None
+
+    async def tunnel_check(self, ip: str, port: int, protocol: str) -> Optional[Tuple[int, str]]:
+        """Validate a CONNECT or SOCKS proxy; returns (speed ms, anonymity) or None.
+
+        Tunnels pass bytes through untouched, so they cannot leak our address in
+        headers; the judge is still used when configured to confirm the round trip.
+        """
+        start_time = time.perf_counter()
+        if protocol == 'CONNECT':
+            # Most CONNECT proxies only open port 443, and a successful handshake is the test
+            _, writer = await asyncio.wait_for(
+                self.raw_probe.open_tunnel(ip, port, protocol, urlsplit(TEST_URL).hostname, 443), self.timeout)
+            writer.close()
+            return int((time.perf_counter() - start_time) * 1000), "Elite"
+        if self.judge_url:
+            nonce = f"{random.getrandbits(64):016x}"
+            status, _, body = await self.raw_probe.fetch_through_tunnel(
+                ip, port, protocol, f"{self.judge_url.rstrip('/')}/?nonce={nonce}", self.timeout)
+            speed = int((time.perf_counter() - start_time) * 1000)
+            echo = json.loads(body or b'null') if status == 200 else None
+            if not isinstance(echo, dict) or echo.get('nonce') != nonce:
+                return None
+            return speed, judge_anonymity(await self.judge_origin_ip(), echo, {})
+        status, _, _ = await self.raw_probe.fetch_through_tunnel(ip, port, protocol, TEST_URL, self.timeout)
+        if status != 204:
+            return None
+        return int((time.perf_counter() - start_time) * 1000), "Elite"
+
+    def load_hit_protocols(self) -> Dict[str, str]:
+        """Protocol recorded for each scan hit, keyed by 'ip:port'; latest run wins."""
+        self.db_writer.flush()
+        try:
+            rows = self.cursor.execute('SELECT ip, port, protocol FROM scan_hits ORDER BY run_id').fetchall()
+        except sqlite3.Error as e:
+            self.log_debug("Could not load hit protocols: %s", e)
+            return {}
+        return {f"{ip}:{port}": protocol or "HTTP" for ip, port, protocol in rows}
+
+    async def test_proxy_connection(self, proxy: str, protocol: str = "HTTP") -> Tuple[str, Optional[int], str]:
+        """Validate proxy; returns (proxy, speed ms, anonymity).
+
+        On failure speed is None and the last field is the NEGATIVE_CACHE_TTL
+        reason of the final attempt instead of an anonymity level.
+        """
         ip, port = proxy.split(':')
         port = int(port)
-        proxy_url = f"http://{ip}:{port}"
         
         for attempt in range(MAX_RETRIES + 1):
             try:
-                self.log_debug(f"Testing proxy {proxy} (attempt {attempt + 1})")
-                start_time = time.time()
-                async with self.session.get(
-                    TEST_URL,
-                    proxy=proxy_url,
-                    timeout=aiohttp.ClientTimeout(total=self.timeout),
-                    headers=self.get_random_headers()
-                ) as response:
-                    if response.status == 204:
-                        speed = int((time.time() - start_time) * 1000)
-                        anonymity = await self.detect_anonymity(proxy_url)
-                        self.log_debug(f"Proxy {proxy} working (speed: {speed}ms, anonymity: {anonymity})")
-                        return (proxy, speed, anonymity)
-                    elif attempt == MAX_RETRIES:
-                        self.log_debug(f"Proxy {proxy} failed with status {response.status}")
-                        return (proxy, None, "Unknown")
+                self.log_debug("Testing proxy %s (attempt %s)", proxy, attempt + 1)
+                if protocol != "HTTP":
+                    verdict = await self.tunnel_check(ip, port, protocol)
+                else:
+                    verdict = await self.http_check(ip, port)
+                if verdict:
+                    speed, anonymity = verdict
+                    self.log_debug("Proxy %s working (speed: %sms, anonymity: %s)", proxy, speed, anonymity)
+                    return (proxy, speed, anonymity)
+                elif attempt == MAX_RETRIES:
+                    self.log_debug("Proxy %s failed validation", proxy)
+                    return (proxy, None, 'bad_response')
             except Exception as e:
-                self.log_debug(f"Proxy {proxy} failed with error: {str(e)}")
+                self.log_debug("Proxy %s failed with error: %s", proxy, e)
                 if attempt == MAX_RETRIES:
-                    return (proxy, None, "Unknown")
+                    return (proxy, None, dead_reason(e))
                 await asyncio.sleep(random.uniform(0.5, 2.0))
         
-        return (proxy, None, "Unknown")
+        return (proxy, None, 'bad_response')
 
     async def detect_anonymity(self, proxy_url: str) -> str:
         try:
@@ -705,7 +3399,7 @@ class ProxyScanner:
             
             for url in test_urls:
                 try:
-                    self.log_debug(f"Testing anonymity at {url}")
+                    self.log_debug("Testing anonymity at %s", url)
                     async with self.session.get(
                         url,
                         proxy=proxy_url,
@@ -723,103 +3417,188 @@ class ProxyScanner:
                             self.log_debug("Proxy is Transparent")
                             return "Transparent"
                 except Exception as e:
-                    self.log_debug(f"Anonymity test failed for {url}: {str(e)}")
+                    self.log_debug("Anonymity test failed for %s: %s", url, e)
                     continue
             
             self.log_debug("Proxy is Elite")
             return "Elite"
         except Exception as e:
-            self.log_debug(f"Anonymity detection failed: {str(e)}")
+            self.log_debug("Anonymity detection failed: %s", e)
             return "Unknown"
 
-    def save_to_database(self, proxy: str, speed: int, anonymity: str, details: dict) -> None:
+    def save_to_database(self, proxy: str, speed: int, anonymity: str, details: dict,
+                         protocol: str = "HTTP") -> None:
         ip, port = proxy.split(':')
-        try:
-            self.cursor.execute('''
-                INSERT OR REPLACE INTO proxies 
-                (ip, port, country, city, speed, protocol, anonymity, isp, last_checked, is_active)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1)
-            ''', (
-                ip,
-                int(port),
-                details.get("country", "Unknown"),
-                details.get("city", "Unknown"),
-                speed,
-                "HTTP",
-                anonymity,
-                details.get("isp", "Unknown"),
-                datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            ))
-            self.conn.commit()
-            self.log_debug(f"Saved proxy {proxy} to database")
-        except sqlite3.Error as e:
-            print(f"{Colors.YELLOW}[!] Database error saving proxy {proxy}: {e}{Colors.RESET}")
+        self.db_writer.submit('''
+            INSERT OR REPLACE INTO proxies 
+            (ip, port, country, city, speed, protocol, anonymity, isp, last_checked, is_active,
+             next_check, check_interval, fail_count)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1, ?, ?, 0)
+        ''', (
+            ip,
+            int(port),
+            details.get("country", "Unknown"),
+            details.get("city", "Unknown"),
+            speed,
+            protocol,
+            anonymity,
+            details.get("isp", "Unknown"),
+            datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            time.time() + REVALIDATE_MIN_INTERVAL,
+            REVALIDATE_MIN_INTERVAL
+        ))
+        self.log_debug("Queued proxy %s for database", proxy)
 
     def save_working_range(self, ip: str) -> None:
         try:
             network = ipaddress.IPv4Network(f"{ip}/24", strict=False)
+            if self.working_ranges is None:
+                with open(WORKING_RANGES_FILE) as f:
+                    self.working_ranges = {line.strip() for line in f if line.strip()}
+            if str(network) in self.working_ranges:
+                return
+            self.working_ranges.add(str(network))
             with open(WORKING_RANGES_FILE, 'a') as f:
                 f.write(f"{network}\n")
-            self.log_debug(f"Saved working range: {network}")
+            self.log_debug("Saved working range: %s", network)
         except (ipaddress.AddressValueError, IOError) as e:
             print(f"{Colors.YELLOW}[!] Error saving working range for {ip}: {e}{Colors.RESET}")
 
+    def geoip_table(self) -> Optional[GeoIPTable]:
+        """The GeoIP table for GEOIP_FILE, reloaded when the file changes; None without a dataset."""
+        if not os.path.exists(GEOIP_FILE):
+            return None
+        if self.geoip is None or self.geoip.mtime != os.path.getmtime(GEOIP_FILE):
+            self.geoip = load_geoip_table(GEOIP_FILE)
+            self.log_debug("Loaded %s GeoIP ranges", len(self.geoip))
+        return self.geoip
+
     async def get_proxy_details(self, ip: str) -> dict:
-        details = {
-            "country": "IR",
-            "city": "Unknown",
-            "isp": "Unknown"
-        }
-        self.log_debug(f"Generated proxy details: {details}")
+        table = self.geoip_table()
+        if table is not None:
+            details = table.details(ip)
+        else:
+            details = {
+                "country": "IR",
+                "city": "Unknown",
+                "isp": "Unknown"
+            }
+        self.log_debug("Generated proxy details: %s", details)
         return details
 
+    def enrich_proxies(self) -> None:
+        """Fill country, city and isp for every saved proxy from the offline GeoIP table."""
+        table = self.geoip_table()
+        if table is None:
+            print(f"{Colors.RED}[!] No GeoIP dataset found at {GEOIP_FILE}{Colors.RESET}")
+            return
+        self.db_writer.flush()
+        rows = self.cursor.execute('SELECT ip, port FROM proxies').fetchall()
+        start_time = time.time()
+        for ip, port in rows:
+            details = table.details(ip)
+            self.db_writer.submit('UPDATE proxies SET country = ?, city = ?, isp = ? WHERE ip = ? AND port = ?',
+                                  (details["country"], details["city"], details["isp"], ip, port))
+        lookup_time = time.time() - start_time
+        self.db_writer.flush()
+        print(f"{Colors.GREEN}[✓] Enriched {len(rows)} proxies from {len(table)} GeoIP ranges "
+              f"({lookup_time * 1e6 / max(1, len(rows)):.1f}µs per lookup){Colors.RESET}")
+        self.add_scan_result("GeoIP Enrichment", f"Enriched {len(rows)} proxies", "Success")
+
     def view_working_proxies(self) -> None:
         clear_screen()
         print(f"{Colors.CYAN}=== Working Proxies ==={Colors.RESET}")
+        query = self.prompt_proxy_query()
         
+        self.db_writer.flush()
         try:
-            page_size = 20
-            offset = 0
+            total = query.count(self.conn)
+            # Keyset of the row before each page shown so far, for stepping back
+            starts = [None]
             
             while True:
-                self.cursor.execute('''
-                    SELECT ip, port, country, speed, anonymity, isp 
-                    FROM proxies 
-                    WHERE is_active = 1 
-                    ORDER BY speed ASC
-                    LIMIT ? OFFSET ?
-                ''', (page_size, offset))
-                proxies = self.cursor.fetchall()
+                clear_screen()
+                print(f"{Colors.CYAN}=== Working Proxies ==={Colors.RESET}")
+                proxies = query.page(self.conn, starts[-1])
                 
-                if not proxies and offset == 0:
+                if not proxies and len(starts) == 1:
                     print(f"{Colors.YELLOW}No working proxies found in database{Colors.RESET}")
                     break
-                elif not proxies:
-                    print(f"{Colors.YELLOW}\nNo more proxies to display{Colors.RESET}")
-                    break
+                if not proxies:
+                    # Rows went away since the page was reached
+                    starts.pop()
+                    continue
                 
-                print(f"\n{Colors.GREEN}{'IP:Port':<20} {'Country':<10} {'Speed':>7} {'Anonymity':<12} {'ISP'}{Colors.RESET}")
-                for proxy in proxies:
-                    ip, port, country, speed, anonymity, isp = proxy
-                    print(f"{ip}:{port:<15} {country:<10} {speed:>7}ms {anonymity:<12} {isp}")
+                print(f"\n{Colors.GREEN}{'IP:Port':<20} {'Proto':<7} {'Country':<10} {'p50':>7} {'p95':>9} {'Jitter':>9} "
+                      f"{'Anonymity':<12} {'ISP'}{Colors.RESET}")
+                for ip, port, protocol, anonymity, speed, p95, jitter, country, _, isp, _ in proxies:
+                    p95 = f"{p95:.0f}ms" if p95 is not None else "-"
+                    jitter = f"{jitter:.0f}ms" if jitter is not None else "-"
+                    print(f"{ip}:{port:<15} {protocol or 'HTTP':<7} {country:<10} {speed:>5}ms {p95:>9} {jitter:>9} "
+                          f"{anonymity:<12} {isp}")
                 
-                print(f"\n{Colors.YELLOW}Page {offset//page_size + 1} | Total: {offset + len(proxies)} proxies{Colors.RESET}")
+                shown = (len(starts) - 1) * PROXY_PAGE_SIZE
+                print(f"\n{Colors.YELLOW}Page {len(starts)} | Showing {shown + 1}-{shown + len(proxies)} "
+                      f"of {total} proxies{Colors.RESET}")
                 
                 choice = input("\n[N]ext page, [P]revious page, [Q]uit: ").strip().lower()
                 if choice == 'n':
-                    offset += page_size
-                elif choice == 'p' and offset >= page_size:
-                    offset -= page_size
+                    if len(proxies) == PROXY_PAGE_SIZE and shown + len(proxies) < total:
+                        starts.append(row_key(proxies[-1]))
+                    else:
+                        print(f"{Colors.YELLOW}No more proxies to display{Colors.RESET}")
+                        time.sleep(1)
+                elif choice == 'p' and len(starts) > 1:
+                    starts.pop()
                 elif choice == 'q':
                     break
-                clear_screen()
-                print(f"{Colors.CYAN}=== Working Proxies ==={Colors.RESET}")
                 
         except sqlite3.Error as e:
             print(f"{Colors.RED}Database error: {e}{Colors.RESET}")
         
         input("\nPress Enter to continue...")
 
+    def prompt_proxy_query(self) -> ProxyQuery:
+        """Ask for optional filters; empty answers leave a filter off."""
+        anonymity = input("Anonymity (Elite/Anonymous/Transparent, empty for any): ").strip().title()
+        protocol = input(f"Protocol (HTTP/{'/'.join(TUNNEL_PROTOCOLS)}, empty for any): ").strip().upper()
+        age_input = input("Checked within the last N hours (empty for any): ").strip()
+        speed_input = input("Max latency in ms (empty for any): ").strip()
+        return ProxyQuery(anonymity=anonymity or None, protocol=protocol or None,
+                          max_age=float(age_input) * 3600 if age_input.replace('.', '', 1).isdigit() else None,
+                          max_speed=int(speed_input) if speed_input.isdigit() else None)
+
+    def export_proxies(self, path: str, fmt: str, query: ProxyQuery) -> int:
+        """Write every proxy matching query to path as fmt; returns the number written."""
+        self.db_writer.flush()
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', newline='' if fmt == 'csv' else None) as f:
+            count = write_proxies(query.iter_rows(self.conn), f, fmt)
+        os.replace(tmp_path, path)
+        self.log_debug("Exported %s proxies to %s", count, path)
+        return count
+
+    def export_working_proxies(self) -> None:
+        clear_screen()
+        print(f"{Colors.CYAN}=== Export Proxies ==={Colors.RESET}")
+        
+        fmt = input(f"Format ({'/'.join(EXPORT_FORMATS)}, default jsonl): ").strip().lower() or 'jsonl'
+        if fmt not in EXPORT_FORMATS:
+            print(f"{Colors.RED}[!] Unknown format {fmt}{Colors.RESET}")
+            return
+        path = input(f"Output file (default proxies.{fmt}): ").strip() or f"proxies.{fmt}"
+        query = self.prompt_proxy_query()
+        
+        start_time = time.time()
+        try:
+            count = self.export_proxies(path, fmt, query)
+        except (sqlite3.Error, IOError) as e:
+            print(f"{Colors.RED}[!] Export failed: {e}{Colors.RESET}")
+            self.add_scan_result("Export", path, f"Error: {e}")
+            return
+        print(f"{Colors.GREEN}[✓] Exported {count} proxies to {path} in {time.time() - start_time:.2f}s{Colors.RESET}")
+        self.add_scan_result("Export", f"{count} proxies to {path}", "Success")
+
     async def update_iran_ip_ranges(self) -> bool:
         clear_screen()
         print(f"{Colors.MAGENTA}[*] Updating Iranian IP ranges...{Colors.RESET}")
@@ -842,28 +3621,30 @@ class ProxyScanner:
                             line = line.strip()
                             if line and not line.startswith("#"):
                                 try:
-                                    ipaddress.IPv4Network(line)
-                                    if line not in collected_ranges:
-                                        collected_ranges.add(line)
+                                    net = ipaddress.IPv4Network(line, strict=False)
+                                    interval = (int(net.network_address), int(net.broadcast_address))
+                                    if interval not in collected_ranges:
+                                        collected_ranges.add(interval)
                                         new_ranges += 1
                                 except ValueError:
                                     continue
                         print(f"{Colors.GREEN}[+] Found {new_ranges} new ranges{Colors.RESET}")
-                        self.log_debug(f"Found {new_ranges} new ranges from {url}")
+                        self.log_debug("Found %s new ranges from %s", new_ranges, url)
             except Exception as e:
                 print(f"{Colors.RED}[!] Error fetching {url}: {str(e)[:50]}...{Colors.RESET}")
-                self.log_debug(f"Error fetching {url}: {str(e)}")
+                self.log_debug("Error fetching %s: %s", url, e)
         
         if not collected_ranges:
             print(f"{Colors.RED}[!] Failed to fetch any IP ranges{Colors.RESET}")
             return False
         
+        merged = RangeIndex.from_intervals(collected_ranges).to_cidrs()
         try:
             with open(IP_RANGES_FILE, 'w') as f:
-                f.write("\n".join(sorted(collected_ranges)))
-            print(f"{Colors.GREEN}[✓] Saved {len(collected_ranges)} total ranges{Colors.RESET}")
-            self.log_debug(f"Saved {len(collected_ranges)} IP ranges to file")
-            self.add_scan_result("IP Range Update", "Updated Iranian IP ranges", f"Added {len(collected_ranges)} ranges")
+                f.write("\n".join(merged))
+            print(f"{Colors.GREEN}[✓] Saved {len(merged)} merged ranges ({len(collected_ranges)} fetched){Colors.RESET}")
+            self.log_debug("Saved %s IP ranges to file", len(merged))
+            self.add_scan_result("IP Range Update", "Updated Iranian IP ranges", f"Added {len(merged)} ranges")
             return True
         except IOError as e:
             print(f"{Colors.RED}[!] Save error: {e}{Colors.RESET}")
@@ -875,6 +3656,13 @@ class ProxyScanner:
         print(f"Ports: {', '.join(map(str, self.ports))}")
         print(f"Timeout: {self.timeout}s")
         print(f"Threads: {self.concurrency_limit}")
+        print(f"Connect timeout: {self.connect_timeout}s")
+        print(f"Probe engine: {self.probe_engine}")
+        print(f"Processes: {self.processes}")
+        print(f"Revalidation rate: {self.revalidate_rate} checks/s")
+        print(f"Judge URL: {self.judge_url or 'none (public test sites)'}")
+        print(f"Metrics port: {self.metrics_port or 'off'}")
+        print(f"Profiling: {self.profiler.mode}")
         
         print(f"\n{Colors.YELLOW}=== Update Settings ==={Colors.RESET}")
         try:
@@ -887,17 +3675,54 @@ class ProxyScanner:
                         new_ports.append(int(p))
                 if new_ports:
                     self.ports = new_ports
-                    self.log_debug(f"Updated ports to: {self.ports}")
+                    self.log_debug("Updated ports to: %s", self.ports)
             
             timeout_input = input(f"Timeout (current: {self.timeout}s): ").strip()
             if timeout_input and timeout_input.isdigit():
                 self.timeout = max(1, min(int(timeout_input), 30))
-                self.log_debug(f"Updated timeout to: {self.timeout}s")
+                self.log_debug("Updated timeout to: %ss", self.timeout)
             
             threads_input = input(f"Threads (current: {self.concurrency_limit}): ").strip()
             if threads_input and threads_input.isdigit():
                 self.concurrency_limit = max(10, min(int(threads_input), 500))
-                self.log_debug(f"Updated threads to: {self.concurrency_limit}")
+                self.log_debug("Updated threads to: %s", self.concurrency_limit)
+            
+            connect_input = input(f"Connect timeout (current: {self.connect_timeout}s): ").strip()
+            if connect_input:
+                self.connect_timeout = max(0.1, min(float(connect_input), 10))
+                self.log_debug("Updated connect timeout to: %ss", self.connect_timeout)
+            
+            engine_input = input(f"Probe engine ({'/'.join(PROBE_ENGINES)}, current: {self.probe_engine}): ").strip().lower()
+            if engine_input in PROBE_ENGINES:
+                self.probe_engine = engine_input
+                self.log_debug("Updated probe engine to: %s", self.probe_engine)
+            
+            processes_input = input(f"Scan processes (1-{MAX_PROCESSES}, current: {self.processes}): ").strip()
+            if processes_input and processes_input.isdigit():
+                self.processes = max(1, min(int(processes_input), MAX_PROCESSES))
+                self.log_debug("Updated processes to: %s", self.processes)
+            
+            rate_input = input(f"Revalidation rate in checks/s (current: {self.revalidate_rate}): ").strip()
+            if rate_input:
+                self.revalidate_rate = max(0.1, min(float(rate_input), 1000))
+                self.log_debug("Updated revalidation rate to: %s", self.revalidate_rate)
+            
+            judge_input = input("Judge URL (http://host:port/, '-' for public test sites, empty to keep): ").strip()
+            if judge_input == '-' or judge_input.startswith('http://'):
+                self.judge_url = '' if judge_input == '-' else judge_input
+                self.judge_origin = None
+                self.log_debug("Updated judge URL to: %s", self.judge_url)
+            
+            metrics_input = input(f"Metrics port on localhost (0 = off, current: {self.metrics_port}, "
+                                  f"applies on restart): ").strip()
+            if metrics_input.isdigit() and (int(metrics_input) == 0 or 1024 <= int(metrics_input) <= 65535):
+                self.metrics_port = int(metrics_input)
+                self.log_debug("Updated metrics port to: %s", self.metrics_port)
+            
+            profile_input = input(f"Profiling ({'/'.join(PROFILE_MODES)}, current: {self.profiler.mode}): ").strip().lower()
+            if profile_input in PROFILE_MODES:
+                self.profiler.mode = profile_input
+                self.log_debug("Updated profiling to: %s", self.profiler.mode)
             
             self.save_config()
             print(f"{Colors.GREEN}[✓] Settings updated{Colors.RESET}")
@@ -911,28 +3736,24 @@ class ProxyScanner:
         clear_screen()
         print(f"{Colors.CYAN}=== Debug Information ==={Colors.RESET}")
         
-        if not self.debug_log:
-            print(f"{Colors.YELLOW}No debug information available{Colors.RESET}")
+        messages = list(self.debug_log.records)
+        if not messages:
+            print(f"{Colors.YELLOW}No debug information available (enable debug mode to collect it){Colors.RESET}")
         else:
-            print(f"\nLast {min(20, len(self.debug_log))} debug messages:")
-            for msg in self.debug_log[-20:]:
+            print(f"\nLast {min(20, len(messages))} debug messages:")
+            for msg in messages[-20:]:
                 print(f"{Colors.MAGENTA}{msg}{Colors.RESET}")
-            
-            try:
-                with open(DEBUG_LOG_FILE, 'a') as f:
-                    f.write("\n".join(self.debug_log) + "\n")
-                print(f"\n{Colors.GREEN}[✓] Saved {len(self.debug_log)} debug messages to {DEBUG_LOG_FILE}{Colors.RESET}")
-            except IOError as e:
-                print(f"{Colors.RED}[!] Error saving debug log: {e}{Colors.RESET}")
+            print(f"\n{Colors.GREEN}[✓] Full log is written to {DEBUG_LOG_FILE}{Colors.RESET}")
         
         input("\nPress Enter to continue...")
 
     def toggle_debug_mode(self) -> None:
         self.debug_mode = not self.debug_mode
+        self.logger.setLevel(logging.DEBUG if self.debug_mode else logging.INFO)
         status = "ON" if self.debug_mode else "OFF"
         color = Colors.GREEN if self.debug_mode else Colors.RED
         print(f"\n{color}Debug mode is now {status}{Colors.RESET}")
-        self.log_debug(f"Debug mode toggled to {status}")
+        self.log_debug("Debug mode toggled to %s", status)
         input("\nPress Enter to continue...")
 
     async def main_menu(self) -> None:
@@ -951,6 +3772,9 @@ class ProxyScanner:
 {Colors.GREEN}[7]{Colors.RESET} View debug log
 {Colors.GREEN}[8]{Colors.RESET} Toggle debug mode ({'ON' if self.debug_mode else 'OFF'})
 {Colors.GREEN}[9]{Colors.RESET} Save Progress to file
+{Colors.GREEN}[10]{Colors.RESET} Revalidate saved proxies
+{Colors.GREEN}[11]{Colors.RESET} Enrich proxies from GeoIP data
+{Colors.GREEN}[12]{Colors.RESET} Export proxies (JSONL/CSV/ip:port/PAC)
 {Colors.GREEN}[0]{Colors.RESET} Exit
 """)
             choice = input(f"{Colors.BLUE}Select option:{Colors.RESET} ").strip()
@@ -977,6 +3801,15 @@ class ProxyScanner:
             elif choice == "9":
                 self.save_results_to_file()
                 input("\nPress Enter to continue...")
+            elif choice == "10":
+                await self.revalidate_until_enter()
+                input("\nPress Enter to continue...")
+            elif choice == "11":
+                self.enrich_proxies()
+                input("\nPress Enter to continue...")
+            elif choice == "12":
+                self.export_working_proxies()
+                input("\nPress Enter to continue...")
             elif choice == "0":
                 break
             else:
@@ -985,9 +3818,276 @@ class ProxyScanner:
         
         await self.close()
 
+def iter_permuted_tasks(ip_lookup: Callable[[int], str], host_total: int, ports: List[int],
+                        seed: int, start: int = 0, step: int = 1) -> Iterator[Tuple[int, str, int]]:
+    """Yield (counter, ip, port) probes in permuted order from counter `start` onwards.
+
+    With step > 1 only every step-th counter is produced, which is how shards
+    split one permutation between processes.
+    """
+    permutation = FeistelPermutation(host_total * len(ports), seed)
+    for counter in range(start, permutation.size, step):
+        ip_pos, port_idx = divmod(permutation[counter], len(ports))
+        yield counter, ip_lookup(ip_pos), ports[port_idx]
+
+def dump_targets(targets) -> dict:
+    if isinstance(targets, RangeIndex):
+        return {'intervals': targets.intervals()}
+    return {'ips': targets}
+
+def load_targets(stored: dict):
+    if 'intervals' in stored:
+        return RangeIndex.from_intervals(tuple(i) for i in stored['intervals'])
+    return stored['ips']
+
+def run_shard(shard: int, shards: int, stored: dict, ports: List[int], seed: int, start: int,
+              results, stop) -> None:
+    """Process entry point for one scan shard; the parent handles Ctrl-C through `stop`."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    if sys.platform == 'win32':
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+
+    async def run() -> None:
+        scanner = ProxyScanner(shard_worker=True)
+        await scanner.async_init()
+        try:
+            await scanner.scan_shard(shard, shards, load_targets(stored), ports, seed, start, results, stop)
+        finally:
+            await scanner.close()
+
+    asyncio.run(run())
+
 def clear_screen() -> None:
     os.system('cls' if os.name == 'nt' else 'clear')
 
+async def run_fake_proxy(response: bytes = b"HTTP/1.1 204 No Content\r\nServer: nginx\r\n"
+                                           b"Content-Length: 0\r\nConnection: close\r\n\r\n"):
+    """Loopback server answering every request with a canned proxy response."""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            writer.write(response)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    return await asyncio.start_server(handle, '127.0.0.1', 0, backlog=1024)
+
+@contextlib.contextmanager
+def bench_workdir() -> Iterator[str]:
+    """Run a benchmark in a throwaway directory; the cwd is restored and the directory removed after."""
+    previous = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix="proxy-bench-") as workdir:
+        os.chdir(workdir)
+        try:
+            yield workdir
+        finally:
+            os.chdir(previous)
+
+async def benchmark_probe_engines(probes: int) -> None:
+    """Compare CPU per probe and probes/s of each engine against a loopback fake proxy."""
+    with bench_workdir():
+        server = await run_fake_proxy()
+        port = server.sockets[0].getsockname()[1]
+        scanner = ProxyScanner()
+        await scanner.async_init()
+        try:
+            for engine in PROBE_ENGINES:
+                scanner.probe_engine = engine
+                ok = 0
+
+                async def probe(_: int) -> int:
+                    status, _ = await scanner.fetch_via_proxy('127.0.0.1', port, TEST_URL)
+                    return status
+
+                async def count(status: int) -> None:
+                    nonlocal ok
+                    ok += status == 204
+
+                wall, cpu = time.perf_counter(), time.process_time()
+                await scanner.run_worker_pool(range(probes), probe, count)
+                wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+                print(json.dumps({
+                    'engine': engine,
+                    'probes': probes,
+                    'ok': ok,
+                    'probes_per_sec': round(probes / wall, 1),
+                    'cpu_us_per_probe': round(cpu / probes * 1e6, 1)
+                }))
+        finally:
+            server.close()
+            await scanner.close()
+
+def farm_handler(kind: str, rng: random.Random) -> Callable[[asyncio.StreamReader, asyncio.StreamWriter], Awaitable[None]]:
+    """Connection handler for one kind of benchmark farm endpoint; garbage bytes come from `rng`."""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            if kind == 'reset':
+                writer.get_extra_info('socket').setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                                           struct.pack('ii', 1, 0))
+                writer.transport.abort()
+                return
+            if kind == 'tarpit':
+                await reader.read()
+                return
+            await reader.readuntil(b"\r\n\r\n")
+            if kind == 'garbage':
+                writer.write(rng.randbytes(64) + b"\r\n\r\n")
+            else:
+                if kind == 'slow':
+                    await asyncio.sleep(BENCH_SLOW_DELAY)
+                writer.write(b"HTTP/1.1 204 No Content\r\nServer: nginx\r\n"
+                             b"Content-Length: 0\r\nConnection: close\r\n\r\n")
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    return handle
+
+def run_proxy_farm(endpoints: int, seed: int, pipe) -> None:
+    """Process entry point serving `endpoints` loopback ports mixed per BENCH_FARM_MIX.
+
+    Kinds are bound in an order shuffled by `seed`. Sends {kind: [ports]}
+    through `pipe`, then serves until anything is sent back. 'closed' ports
+    were bound and released, so connects to them are refused.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    rng = random.Random(seed)
+
+    async def run() -> None:
+        fd_budget(endpoints + FD_HEADROOM)
+        servers, released = [], []
+        layout = {kind: [] for kind, _ in BENCH_FARM_MIX}
+        kinds = [kind for kind, share in BENCH_FARM_MIX for _ in range(max(1, int(endpoints * share)))]
+        rng.shuffle(kinds)
+        for kind in kinds:
+            if kind == 'closed':
+                sock = socket.socket()
+                sock.bind(('127.0.0.1', 0))
+                released.append(sock)
+                layout[kind].append(sock.getsockname()[1])
+                continue
+            server = await asyncio.start_server(farm_handler(kind, rng), '127.0.0.1', 0)
+            servers.append(server)
+            layout[kind].append(server.sockets[0].getsockname()[1])
+        for sock in released:
+            sock.close()
+        pipe.send(layout)
+        await asyncio.get_running_loop().run_in_executor(None, pipe.recv)
+        for server in servers:
+            server.close()
+
+    asyncio.run(run())
+
+def bench_report(probes: int, wall: float, cpu: float, positives: Set[int],
+                 expected: Set[int], universe: Set[int]) -> dict:
+    false_positives = len(positives - expected)
+    false_negatives = len((expected & universe) - positives)
+    return {
+        'probes': probes,
+        'seconds': round(wall, 3),
+        'probes_per_sec': round(probes / wall, 1),
+        'cpu_us_per_probe': round(cpu / max(1, probes) * 1e6, 1),
+        'true_positives': len(positives & expected),
+        'false_positives': false_positives,
+        'false_negatives': false_negatives,
+        'accuracy': round(1 - (false_positives + false_negatives) / max(1, len(universe)), 4)
+    }
+
+async def benchmark_farm(endpoints: int, seed: Optional[int] = None) -> None:
+    """Scan and test a loopback farm of fake endpoints and print one JSON report on stdout.
+
+    The farm runs in its own process so CPU and RSS figures cover the scanner only.
+    Working and slow endpoints should be found; tarpits, resets, garbage and
+    closed ports should not. `seed` (random if None) drives both the farm
+    layout and the scan order, and is part of the report.
+    """
+    if seed is None:
+        seed = random.getrandbits(63)
+    with bench_workdir():
+        context = multiprocessing.get_context('spawn')
+        parent, child = context.Pipe()
+        farm = context.Process(target=run_proxy_farm, args=(endpoints, seed, child), name="proxy-farm")
+        farm.start()
+        layout = await asyncio.get_running_loop().run_in_executor(None, parent.recv)
+        ports = sorted(port for kind_ports in layout.values() for port in kind_ports)
+        expected = set(layout['working']) | set(layout['slow'])
+        scanner = ProxyScanner()
+        scanner.timeout = BENCH_TIMEOUT
+        await scanner.async_init()
+        try:
+            report = {
+                'seed': seed,
+                'endpoints': {kind: len(kind_ports) for kind, kind_ports in layout.items()},
+                'engine': scanner.probe_engine,
+                'threads': scanner.concurrency_limit,
+                'timeout': scanner.timeout
+            }
+            with contextlib.redirect_stdout(sys.stderr):
+                run_id = scanner.create_scan_run("Benchmark Scan", ['127.0.0.1'], seed, ports)
+                wall, cpu = time.perf_counter(), time.process_time()
+                await scanner.run_scan("Benchmark Scan", ['127.0.0.1'], ports, seed, run_id)
+                wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+                with open(OPEN_PROXIES_FILE) as f:
+                    found = {int(line.split(':')[1]) for line in f if line.strip()}
+                report['scan'] = bench_report(len(ports), wall, cpu, found, expected, set(ports))
+
+                wall, cpu = time.perf_counter(), time.process_time()
+                await scanner.test_working_proxies()
+                wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+                with open(WORKING_PROXIES_FILE) as f:
+                    verified = {int(line.split(':')[1]) for line in f if line.strip()}
+                report['test'] = bench_report(len(found), wall, cpu, verified, expected, found)
+            report['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None
+            print(json.dumps(report))
+        finally:
+            await scanner.close()
+            parent.send('stop')
+            farm.join()
+
+async def main_distributed(coordinator: Optional[str], worker_url: Optional[str], unit_size: int) -> None:
+    scanner = ProxyScanner(shard_worker=worker_url is not None)
+    await scanner.async_init()
+    try:
+        if coordinator:
+            host, _, port = coordinator.rpartition(':')
+            await scanner.run_coordinator(host or '127.0.0.1', int(port), unit_size)
+        else:
+            await scanner.run_distributed_worker(worker_url)
+    except aiohttp.ClientError as e:
+        print(f"{Colors.RED}[!] Coordinator unreachable: {e}{Colors.RESET}")
+    finally:
+        await scanner.close()
+
+async def main_judge(address: str) -> None:
+    host, _, port = address.rpartition(':')
+    runner = await run_judge_server(host or '0.0.0.0', int(port))
+    print(f"{Colors.GREEN}[✓] Judge listening on {address}; set http://<this host>:{port}/ "
+          f"as the judge URL in Settings{Colors.RESET}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+async def main_revalidate() -> None:
+    scanner = ProxyScanner()
+    await scanner.async_init()
+    try:
+        await scanner.revalidate_proxies(asyncio.Event())
+    finally:
+        await scanner.close()
+
+async def main_export(fmt: str, path: Optional[str], query: ProxyQuery) -> None:
+    scanner = ProxyScanner()
+    try:
+        path = path or f"proxies.{fmt}"
+        count = scanner.export_proxies(path, fmt, query)
+        print(f"{Colors.GREEN}[✓] Exported {count} proxies to {path}{Colors.RESET}")
+    finally:
+        await scanner.close()
+
 async def main():
     scanner = ProxyScanner()
     try:
@@ -1003,7 +4103,51 @@ if __name__ == "__main__":
     if sys.platform == 'win32':
         asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
     
+    parser = argparse.ArgumentParser(description="Http Proxy Scanner")
+    parser.add_argument('--bench-engines', type=int, metavar='PROBES',
+                        help="benchmark the aiohttp and raw probe engines against a loopback fake proxy")
+    parser.add_argument('--bench-farm', type=int, metavar='ENDPOINTS',
+                        help="scan and test a loopback farm of fake proxies and print a JSON report")
+    parser.add_argument('--seed', type=int, help="farm layout and scan order seed for --bench-farm")
+    parser.add_argument('--coordinator', metavar='HOST:PORT',
+                        help="serve lease-based work units of a distributed scan over all IP ranges")
+    parser.add_argument('--worker', metavar='URL',
+                        help="scan work units leased from the coordinator at URL")
+    parser.add_argument('--unit-size', type=int, default=DEFAULT_UNIT_SIZE,
+                        help="probes per work unit for a new distributed scan")
+    parser.add_argument('--judge', metavar='HOST:PORT',
+                        help="serve a judge endpoint that echoes client IP and headers for proxy validation")
+    parser.add_argument('--revalidate', action='store_true',
+                        help="keep rechecking saved proxies until interrupted")
+    parser.add_argument('--export', choices=EXPORT_FORMATS,
+                        help="stream the working proxies, fastest first, to a file and exit")
+    parser.add_argument('--output', metavar='PATH',
+                        help="file for --export (default proxies.FORMAT)")
+    parser.add_argument('--anonymity', type=str.title, help="only export proxies of this anonymity level")
+    parser.add_argument('--protocol', type=str.upper, help="only export proxies speaking this protocol")
+    parser.add_argument('--max-age', type=float, metavar='HOURS',
+                        help="only export proxies checked within the last HOURS")
+    parser.add_argument('--max-latency', type=int, metavar='MS',
+                        help="only export proxies at most this slow")
+    args = parser.parse_args()
+    
     try:
-        asyncio.run(main())
+        if args.bench_engines:
+            asyncio.run(benchmark_probe_engines(args.bench_engines))
+        elif args.bench_farm:
+            asyncio.run(benchmark_farm(args.bench_farm, args.seed))
+        elif args.judge:
+            asyncio.run(main_judge(args.judge))
+        elif args.revalidate:
+            asyncio.run(main_revalidate())
+        elif args.export:
+            query = ProxyQuery(anonymity=args.anonymity, protocol=args.protocol,
+                               max_age=args.max_age * 3600 if args.max_age is not None else None,
+                               max_speed=args.max_latency)
+            asyncio.run(main_export(args.export, args.output, query))
+        elif args.coordinator or args.worker:
+            asyncio.run(main_distributed(args.coordinator, args.worker, args.unit_size))
+        else:
+            asyncio.run(main())
     except KeyboardInterrupt:
         print(f"\n{Colors.RED}[!] Program terminated{Colors.RESET}")
@@ -0,0 +1,38 @@
+import asyncio
+import importlib.util
+import pathlib
+import sys
+
+import pytest
+
+SCRIPT = pathlib.Path(__file__).resolve().parent.parent / "http-proxy-scanner.py"
+
+# The script's name is not importable, so load it once under one that is
+spec = importlib.util.spec_from_file_location("http_proxy_scanner", SCRIPT)
+module = importlib.util.module_from_spec(spec)
+sys.modules["http_proxy_scanner"] = module
+spec.loader.exec_module(module)
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    """Run in an empty directory, where the scanner keeps its database and files, with no proxy in the env."""
+    monkeypatch.chdir(tmp_path)
+    for name in ("HTTP_PROXY", "http_proxy", "HTTPS_PROXY", "https_proxy", "ALL_PROXY", "all_proxy"):
+        monkeypatch.delenv(name, raising=False)
+    return tmp_path
+
+
+@pytest.fixture
+def with_scanner(workdir):
+    """Run `body(scanner)` on a fresh event loop with an initialised ProxyScanner."""
+    def run(body):
+        async def main():
+            scanner = module.ProxyScanner()
+            await scanner.async_init()
+            try:
+                return await body(scanner)
+            finally:
+                await scanner.close()
+        return asyncio.run(main())
+    return run
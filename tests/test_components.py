@@ -0,0 +1,138 @@
+import ipaddress
+import random
+import sqlite3
+
+import pytest
+
+import http_proxy_scanner as hps
+
+
+def address(text):
+    return int(ipaddress.IPv4Address(text))
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 17, 1000, 4097])
+def test_feistel_is_a_bijection(size):
+    permutation = hps.FeistelPermutation(size, seed=12345)
+    assert sorted(permutation[i] for i in range(size)) == list(range(size))
+
+
+def test_feistel_depends_on_seed_and_rejects_out_of_range():
+    first = [hps.FeistelPermutation(1000, 1)[i] for i in range(1000)]
+    again = [hps.FeistelPermutation(1000, 1)[i] for i in range(1000)]
+    other = [hps.FeistelPermutation(1000, 2)[i] for i in range(1000)]
+    assert first == again
+    assert first != other
+    with pytest.raises(IndexError):
+        hps.FeistelPermutation(10, 1)[10]
+
+
+def test_range_index_merges_and_maps_positions():
+    index = hps.RangeIndex.from_lines([
+        "10.0.0.0/30", "10.0.0.4/30",  # adjacent, merged
+        "10.0.0.2/31",                 # contained
+        "# comment", "not a network",
+        "192.168.1.0/24",
+    ])
+    assert index.intervals() == [(address("10.0.0.0"), address("10.0.0.7")),
+                                 (address("192.168.1.0"), address("192.168.1.255"))]
+    assert index.total == 8 + 256
+    for position in range(index.total):
+        assert index.position_of(index.address_at(position)) == position
+    assert index.ip_at(8) == "192.168.1.0"
+    assert "10.0.0.5" in index and "10.0.0.8" not in index
+    assert index.position_of(address("10.0.0.8")) is None
+    with pytest.raises(IndexError):
+        index.address_at(index.total)
+
+
+def test_range_index_set_operations_and_file_round_trip(tmp_path):
+    index = hps.RangeIndex.from_lines(["10.0.0.0/24"])
+    cut = index.difference(hps.RangeIndex.from_lines(["10.0.0.64/26"]))
+    assert cut.to_cidrs() == ["10.0.0.0/26", "10.0.0.128/25"]
+    assert cut.union(hps.RangeIndex.from_lines(["10.0.0.64/26"])).to_cidrs() == ["10.0.0.0/24"]
+
+    path = str(tmp_path / "ranges.idx")
+    cut.save(path)
+    loaded = hps.RangeIndex.load(path)
+    assert loaded.intervals() == cut.intervals()
+    assert loaded.total == cut.total
+    assert loaded.ip_at(64) == "10.0.0.128"
+
+
+def test_bloom_filter_has_no_false_negatives_and_few_false_positives():
+    bloom = hps.BloomFilter(10000)
+    values = random.Random(7).sample(range(1 << 32), 20000)
+    members, others = values[:10000], values[10000:]
+    # A new value only looks present on a false positive
+    assert sum(bloom.add(value) for value in members) >= (1 - 3 * hps.BLOOM_ERROR_RATE) * len(members)
+    assert not any(bloom.add(value) for value in members)
+    assert all(value in bloom for value in members)
+    false_positives = sum(value in bloom for value in others)
+    assert false_positives <= 3 * hps.BLOOM_ERROR_RATE * len(others)
+
+
+def test_alias_tables_reproduce_range_weights():
+    index = hps.RangeIndex.from_lines(["10.0.0.0/24", "10.0.1.0/24", "10.1.0.0/16", "10.2.0.0/30"])
+    stats = {"10.0.0.0/24": (1000, 500), "10.1.0.0/16": (5000, 0)}
+    sampler = hps.WeightedRangeSampler(index, stats)
+
+    weights = [(end - start + 1) * hps.range_hit_rate(stats.get(hps.format_interval(start, end)))
+               for start, end in index.intervals()]
+    count = len(weights)
+    probabilities = [prob / count for prob in sampler.prob]
+    for i, alias in enumerate(sampler.alias):
+        probabilities[alias] += (1 - sampler.prob[i]) / count
+    assert probabilities == pytest.approx([weight / sum(weights) for weight in weights])
+
+
+def test_alias_draws_stay_inside_the_index():
+    index = hps.RangeIndex.from_lines(["10.0.0.0/30", "172.16.5.0/29"])
+    sampler = hps.WeightedRangeSampler(index, {})
+    random.seed(3)
+    assert all(sampler.draw() in index for _ in range(2000))
+
+
+@pytest.fixture
+def proxies_db():
+    conn = sqlite3.connect(":memory:")
+    conn.execute('''CREATE TABLE proxies (ip TEXT, port INTEGER, country TEXT, city TEXT, speed INTEGER,
+                    protocol TEXT, anonymity TEXT, isp TEXT, last_checked TEXT, is_active INTEGER DEFAULT 1,
+                    PRIMARY KEY (ip, port))''')
+    conn.execute('''CREATE TABLE latency_stats (ip TEXT, port INTEGER, p50_ms REAL, p95_ms REAL, jitter_ms REAL,
+                    connect_ms REAL, ttfb_ms REAL, samples INTEGER, PRIMARY KEY (ip, port))''')
+    rng = random.Random(11)
+    rows = []
+    for i in range(137):
+        # Few distinct speeds, so pages have to break ties on (ip, port)
+        rows.append((f"10.0.{i % 7}.{i}", 8080 + i % 3, "IR", "Tehran", rng.choice([100, 200, 300]),
+                     "SOCKS5" if i % 4 == 0 else "HTTP", "Elite", "isp", "2026-01-01 00:00:00", int(i % 10 != 0)))
+    conn.executemany('INSERT INTO proxies VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+    yield conn
+    conn.close()
+
+
+def test_keyset_pages_cover_every_row_once_in_order(proxies_db):
+    query = hps.ProxyQuery()
+    expected = proxies_db.execute('''
+        SELECT ip, port FROM proxies WHERE is_active = 1 ORDER BY speed, ip, port
+    ''').fetchall()
+
+    pages, after = [], None
+    while True:
+        page = query.page(proxies_db, after, limit=10)
+        if not page:
+            break
+        pages.append(page)
+        after = hps.row_key(page[-1])
+    assert [(row[0], row[1]) for page in pages for row in page] == expected
+    assert all(len(page) == 10 for page in pages[:-1])
+    assert query.count(proxies_db) == len(expected)
+    assert [(row[0], row[1]) for row in query.iter_rows(proxies_db, batch=7)] == expected
+
+
+def test_keyset_filters(proxies_db):
+    query = hps.ProxyQuery(protocol="SOCKS5", max_speed=200)
+    rows = list(query.iter_rows(proxies_db, batch=5))
+    assert rows and len(rows) == query.count(proxies_db)
+    assert all(row[2] == "SOCKS5" and row[4] <= 200 for row in rows)
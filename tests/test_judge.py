@@ -0,0 +1,75 @@
+import asyncio
+from urllib.parse import urlsplit
+
+import pytest
+
+import http_proxy_scanner as hps
+
+
+async def start_forwarding_proxy(extra_headers):
+    """Plain HTTP forward proxy on loopback that adds `extra_headers` to every request it relays."""
+    async def handle(reader, writer):
+        try:
+            head = await reader.readuntil(b"\r\n\r\n")
+            request_line, *lines = head.decode("latin-1").split("\r\n")
+            method, url, version = request_line.split(" ")
+            parts = urlsplit(url)
+            path = parts.path or "/"
+            if parts.query:
+                path += f"?{parts.query}"
+            upstream_reader, upstream_writer = await asyncio.open_connection(parts.hostname, parts.port)
+            forwarded = [f"{method} {path} {version}"] + [line for line in lines if line]
+            forwarded += [f"{name}: {value}" for name, value in extra_headers.items()]
+            upstream_writer.write(("\r\n".join(forwarded) + "\r\n\r\n").encode("latin-1"))
+            writer.write(await upstream_reader.read())
+            await writer.drain()
+            upstream_writer.close()
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, "127.0.0.1", 0)
+    return server, server.sockets[0].getsockname()[1]
+
+
+@pytest.mark.parametrize("extra_headers, expected", [
+    ({}, "Elite"),
+    ({"Via": "1.1 squid"}, "Anonymous"),
+    ({"Via": "1.1 squid", "X-Forwarded-For": "127.0.0.1"}, "Transparent"),
+])
+def test_judge_classifies_anonymity(with_scanner, extra_headers, expected):
+    async def body(scanner):
+        judge = await hps.run_judge_server("127.0.0.1", 0)
+        proxy, port = await start_forwarding_proxy(extra_headers)
+        try:
+            judge_port = judge.addresses[0][1]
+            scanner.judge_url = f"http://127.0.0.1:{judge_port}/"
+            scanner.timeout = 2
+            checked = await scanner.judge_check("127.0.0.1", port)
+            assert checked is not None
+            timing, anonymity = checked
+            assert anonymity == expected
+            connect, first_byte, total = timing
+            assert 0 <= connect <= first_byte <= total
+
+            speed, anonymity = await scanner.http_check("127.0.0.1", port)
+            assert anonymity == expected
+        finally:
+            proxy.close()
+            await judge.cleanup()
+
+    with_scanner(body)
+
+
+def test_judge_rejects_a_proxy_that_does_not_relay(with_scanner):
+    async def body(scanner):
+        judge = await hps.run_judge_server("127.0.0.1", 0)
+        fake = await hps.run_fake_proxy()
+        try:
+            scanner.judge_url = f"http://127.0.0.1:{judge.addresses[0][1]}/"
+            scanner.timeout = 2
+            assert await scanner.judge_check("127.0.0.1", fake.sockets[0].getsockname()[1]) is None
+        finally:
+            fake.close()
+            await judge.cleanup()
+
+    with_scanner(body)
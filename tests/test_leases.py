@@ -0,0 +1,44 @@
+import time
+
+import http_proxy_scanner as hps
+
+
+def prepare_run(workdir, scanner, unit_size):
+    (workdir / hps.IP_RANGES_FILE).write_text("10.0.0.0/30\n")
+    scanner.ports = [80, 8080]
+    return scanner.prepare_distributed_run(unit_size)
+
+
+def test_units_are_leased_once_until_done(with_scanner, workdir):
+    async def body(scanner):
+        run_id = prepare_run(workdir, scanner, unit_size=3)
+        # 4 hosts x 2 ports = 8 probes in units of 3
+        leases = [scanner.lease_work_unit(run_id, f"worker-{i}") for i in range(4)]
+        assert [lease[1:] for lease in leases[:3]] == [(0, 3), (3, 6), (6, 8)]
+        assert leases[3] is None
+        assert scanner.prepare_distributed_run(3) == run_id
+
+    with_scanner(body)
+
+
+def test_expired_lease_is_reassigned(with_scanner, workdir, monkeypatch):
+    async def body(scanner):
+        run_id = prepare_run(workdir, scanner, unit_size=4)
+        monkeypatch.setattr(hps, "LEASE_SECONDS", 0.05)
+        first = scanner.lease_work_unit(run_id, "slow")
+        second = scanner.lease_work_unit(run_id, "fast")
+        assert first[0] != second[0]
+        assert scanner.lease_work_unit(run_id, "late") is None
+
+        time.sleep(0.1)
+        scanner.cursor.execute('''
+            UPDATE work_units SET status = 'done' WHERE run_id = ? AND unit = ?
+        ''', (run_id, second[0]))
+        reassigned = scanner.lease_work_unit(run_id, "late")
+        assert reassigned == first
+        worker, = scanner.cursor.execute('''
+            SELECT worker FROM work_units WHERE run_id = ? AND unit = ?
+        ''', (run_id, first[0])).fetchone()
+        assert worker == "late"
+
+    with_scanner(body)